@@ -1,9 +1,31 @@
-""" Get Bastion AMI for every region
+""" Get Bastion AMIs for every region
+
+The AMIMap of the bastion template has one key per architecture: AMI is the x86_64 Amazon
+Linux image the bastion runs, and AMIArm64 the arm64 Amazon Linux 2 image kept ready for
+Graviton instances. A region without an image for an architecture only has the keys it does have.
 """
 
-import boto3, botocore, sys, os
+import boto3, botocore, sys, os, time, argparse, json, hashlib
+from multiprocessing.pool import ThreadPool
 from ruamel.yaml import YAML
+from ruamel.yaml.comments import CommentedMap
 from botocore.client import Config
+from metrics import ApiMetrics
+from ratelimit import RateLimiter, parse_rates, rate_option
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+DEFAULT_WORKERS=8
+
+CACHE_FILE='ami-cache.json'
+METRICS_FILE='api-calls.jsonl'
+CACHE_VERSION=1
+DEFAULT_TTL=24 * 60 * 60
+
+BASTION_TEMPLATE=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'templates', 'bastion.cfn.yml')
 
 def get_regions(client):
     """ Load the region codes
@@ -14,45 +36,290 @@ def get_regions(client):
         regions.append(region['RegionName'])
     return regions
 
-def bastion_ami(session, config, region):
-	bastion_ami = []
-	ami_filters= [
-	{'Name':'virtualization-type','Values':['hvm']},
-	{'Name':'hypervisor','Values':['xen']},
-	{'Name':'owner-alias','Values':['amazon']},
-	{'Name':'ena-support','Values':['true']},
-	{'Name':'sriov-net-support','Values':['simple']},
-	{'Name':'state','Values':['available']},
-	{'Name':'architecture','Values':['x86_64']},
-	{'Name':'root-device-type','Values':['ebs']},
-	{'Name':'root-device-name','Values':['/dev/xvda']},
-	{'Name':'image-type','Values':['machine']},
-	{'Name':'is-public','Values':['true']},
-	{'Name':'block-device-mapping.volume-type','Values':['gp2']},
-	{'Name':'block-device-mapping.volume-size','Values':['8']},
-	{'Name':'block-device-mapping.delete-on-termination','Values':['true']},
-	{'Name':'block-device-mapping.device-name','Values':['/dev/xvda']}]
-
-	ec2_client = session.client('ec2', region_name=region, config= config)
-	amis =  ec2_client.describe_images(ExecutableUsers=['all'], Owners=['amazon'], Filters = ami_filters)['Images']
-	exclude_names = [ 'elasticbeanstalk', 'ecs', 'amzn2', 'test' ]
-
-	for ami in amis:
-		if not any(exclude_name in ami['Name'] for exclude_name in exclude_names):
-			bastion_ami.append(ami)
-
-	sort_list = [(dict_['CreationDate'], dict_) for dict_ in bastion_ami]
-	sort_list.sort(reverse=True)
-	return sort_list[0][1]['ImageId']
+def get_clients(session, config, regions):
+    """ Build one EC2 client per region, botocore clients are thread safe but sessions are not
+    """
+    clients = {}
+    for region in regions:
+        clients[region] = session.client('ec2', region_name=region, config=config)
+    return clients
+
+AMI_FILTERS = [
+    {'Name':'virtualization-type','Values':['hvm']},
+    {'Name':'hypervisor','Values':['xen']},
+    {'Name':'owner-alias','Values':['amazon']},
+    {'Name':'ena-support','Values':['true']},
+    {'Name':'sriov-net-support','Values':['simple']},
+    {'Name':'state','Values':['available']},
+    {'Name':'architecture','Values':['x86_64']},
+    {'Name':'root-device-type','Values':['ebs']},
+    {'Name':'root-device-name','Values':['/dev/xvda']},
+    {'Name':'image-type','Values':['machine']},
+    {'Name':'is-public','Values':['true']},
+    {'Name':'block-device-mapping.volume-type','Values':['gp2']},
+    {'Name':'block-device-mapping.volume-size','Values':['8']},
+    {'Name':'block-device-mapping.delete-on-termination','Values':['true']},
+    {'Name':'block-device-mapping.device-name','Values':['/dev/xvda']}]
+
+EXCLUDE_NAMES = [ 'elasticbeanstalk', 'ecs', 'amzn2', 'test' ]
+
+# Amazon Linux has no arm64 images, Graviton bastions run Amazon Linux 2
+ARM64_AMI_FILTERS = [
+    {'Name':'name','Values':['amzn2-ami-hvm-*-arm64-gp2']},
+    {'Name':'virtualization-type','Values':['hvm']},
+    {'Name':'owner-alias','Values':['amazon']},
+    {'Name':'ena-support','Values':['true']},
+    {'Name':'state','Values':['available']},
+    {'Name':'architecture','Values':['arm64']},
+    {'Name':'root-device-type','Values':['ebs']},
+    {'Name':'root-device-name','Values':['/dev/xvda']},
+    {'Name':'image-type','Values':['machine']},
+    {'Name':'is-public','Values':['true']},
+    {'Name':'block-device-mapping.volume-type','Values':['gp2']},
+    {'Name':'block-device-mapping.delete-on-termination','Values':['true']},
+    {'Name':'block-device-mapping.device-name','Values':['/dev/xvda']}]
+
+ARM64_EXCLUDE_NAMES = [ 'elasticbeanstalk', 'ecs', 'minimal', 'test' ]
+
+# AMIMap key, filters and excluded names of every architecture, the first one must exist in every region
+ARCHITECTURES = [
+    ('AMI', AMI_FILTERS, EXCLUDE_NAMES),
+    ('AMIArm64', ARM64_AMI_FILTERS, ARM64_EXCLUDE_NAMES)]
+
+PAGE_SIZE=1000
+
+def newest_image(pages, exclude_names):
+    """ Walk describe_images pages and keep only the newest image whose name is not excluded
+    """
+    newest = None
+    for page in pages:
+        for ami in page['Images']:
+            if any(exclude_name in ami.get('Name', '') for exclude_name in exclude_names):
+                continue
+            # CreationDate is ISO 8601 so string comparison orders by time, ImageId breaks ties
+            if newest is None or (ami['CreationDate'], ami['ImageId']) > (newest['CreationDate'], newest['ImageId']):
+                newest = ami
+    return newest
+
+def bastion_ami(ec2_client, filters=AMI_FILTERS, exclude_names=EXCLUDE_NAMES):
+    """ Return the id of the newest Amazon Linux image matching the bastion filters
+    """
+    paginator = ec2_client.get_paginator('describe_images')
+    pages = paginator.paginate(ExecutableUsers=['all'], Owners=['amazon'], Filters=filters,
+        PaginationConfig={'PageSize': PAGE_SIZE})
+
+    ami = newest_image(pages, exclude_names)
+    if ami is None:
+        raise LookupError('No image matches the bastion AMI filters')
+    return ami['ImageId']
+
+def bastion_amis(ec2_client, architectures=ARCHITECTURES):
+    """ Return {AMIMap key: image id} of every architecture, None for one the region has no image for
+    """
+    amis = {}
+    for i, (key, filters, exclude_names) in enumerate(architectures):
+        try:
+            amis[key] = bastion_ami(ec2_client, filters, exclude_names)
+        except LookupError:
+            if i == 0:
+                raise
+            amis[key] = None
+    return amis
+
+def timed_bastion_ami(job):
+    """ Look up the bastion AMIs for one region, returns (region, amis, seconds, error)
+    """
+    region, ec2_client = job
+    start = time.time()
+    try:
+        return region, bastion_amis(ec2_client), time.time() - start, None
+    except Exception as e:
+        return region, None, time.time() - start, e
+
+def ami_entry(amis):
+    """ The AMIMap entry of a region, in ARCHITECTURES order and without the missing images
+    """
+    return CommentedMap((key, amis[key]) for key, _, _ in ARCHITECTURES if amis.get(key))
+
+def discover_amis(clients, workers):
+    """ Fan the AMI lookups out over a bounded pool and return the AMIs ordered by region
+    """
+    found = {}
+    pool = ThreadPool(max(1, min(workers, len(clients))))
+    try:
+        # Results are reported as they complete so a slow region does not hide the others
+        for region, ami, seconds, error in pool.imap_unordered(timed_bastion_ami, sorted(clients.items())):
+            if error is not None:
+                sys.stderr.write('{:<16} FAILED after {:.2f}s: {}\n'.format(region, seconds, error))
+                continue
+            sys.stderr.write('{:<16} {} in {:.2f}s\n'.format(region, ' '.join(str(ami[key]) for key, _, _ in ARCHITECTURES), seconds))
+            found[region] = ami
+    finally:
+        pool.close()
+        pool.join()
+
+    # Missing images are kept as None so the cache remembers the region was checked
+    amis = CommentedMap()
+    for region in sorted(found):
+        amis[region] = found[region]
+    return amis
+
+def filter_key(filters, exclude_names):
+    """ Stable key for a filter set so cached AMIs from different filters never mix
+    """
+    blob = json.dumps({'filters': filters, 'exclude': sorted(exclude_names)}, sort_keys=True)
+    return hashlib.sha1(blob.encode('utf-8')).hexdigest()
+
+def load_cache(path):
+    """ Load the AMI cache, a missing or unreadable cache is treated as empty
+    """
+    try:
+        with open(path) as f:
+            cache = json.load(f)
+        if cache.get('version') == CACHE_VERSION:
+            return cache
+    except (IOError, OSError, ValueError):
+        pass
+    return {'version': CACHE_VERSION, 'entries': {}}
+
+def save_cache(path, cache):
+    """ Write the cache next to its final location first so an interrupted run cannot corrupt it
+    """
+    tmp = '{}.tmp'.format(path)
+    with open(tmp, 'w') as f:
+        json.dump(cache, f, indent=2, sort_keys=True)
+    os.rename(tmp, path)
+
+def is_stale(entry, now, ttl):
+    return entry is None or now - entry['Checked'] > ttl
+
+def load_template(path):
+    """ Load a template in round-trip mode, returns the raw text and the document
+    """
+    with open(path) as f:
+        text = f.read()
+    return text, YAML().load(text)
+
+def read_ami_map(path):
+    """ Return the region -> {AMIMap key: AMI id} entries currently in the template AMIMap
+    """
+    doc = load_template(path)[1]
+    return dict((region, dict(entry)) for region, entry in doc['Mappings']['AMIMap'].items())
+
+def patch_ami_map(path, amis):
+    """ Update the AMIMap mapping of a template in place and return the (region, key) pairs that changed
+
+    Only the lines of the AMIMap block are rewritten, the block itself is edited in
+    round-trip mode so existing region order and comments are kept and new regions
+    are appended at the end.
+    """
+    text, doc = load_template(path)
+    mappings = doc['Mappings']
+    ami_map = mappings['AMIMap']
+
+    changed = []
+    for region, entry in amis.items():
+        if region not in ami_map:
+            ami_map[region] = CommentedMap()
+        for key, ami in entry.items():
+            if ami_map[region].get(key) != ami:
+                ami_map[region][key] = ami
+                changed.append((region, key))
+
+    if not changed:
+        return changed
+
+    # Blank lines after the block are attached to the last AMI value, drop them from the
+    # mapping and keep the ones already in the file instead
+    for entry in ami_map.values():
+        for key in list(entry.ca.items):
+            del entry.ca.items[key]
+
+    lines = text.splitlines(True)
+    first = mappings.lc.key('AMIMap')[0]
+    indent = mappings.lc.key('AMIMap')[1]
+    last = first
+    for i in range(first + 1, len(lines)):
+        stripped = lines[i].strip()
+        if not stripped:
+            continue
+        if len(lines[i]) - len(lines[i].lstrip()) <= indent:
+            break
+        last = i
+
+    block = CommentedMap()
+    block['AMIMap'] = ami_map
+    out = StringIO()
+    yaml = YAML()
+    yaml.indent(mapping=2)
+    yaml.dump(block, out)
+    dumped = [(' ' * indent + line if line.strip() else line) for line in out.getvalue().rstrip().splitlines(True)]
+    dumped[-1] += '\n'
+
+    with open(path, 'w') as f:
+        f.write(''.join(lines[:first] + dumped + lines[last + 1:]))
+    return changed
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Find the latest bastion AMI in every region')
+    parser.add_argument('profile', nargs='?', default=None, help='AWS CLI profile name')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help='Regions queried concurrently, 1 queries them one at a time')
+    parser.add_argument('--cache', default=CACHE_FILE, help='AMI cache file')
+    parser.add_argument('--ttl', type=int, default=DEFAULT_TTL, help='Seconds a cached AMI is trusted by --changed-only')
+    parser.add_argument('--changed-only', action='store_true', help='Only query regions whose cache entry is stale, missing or differs from the template')
+    parser.add_argument('--template', default=BASTION_TEMPLATE, help='Template whose AMIMap is updated')
+    parser.add_argument('--no-template', dest='template', action='store_const', const=None, help='Do not update a template')
+    parser.add_argument('--metrics', default=METRICS_FILE, help='File each API call is appended to as a JSON line')
+    parser.add_argument('--rate', action='append', type=rate_option, metavar='SERVICE=N', help='Starting calls per second per region for a service, repeatable')
+    parser.add_argument('--no-rate-limit', dest='rate_limit', action='store_false', help='Do not pace the API calls')
+    return parser.parse_args()
 
 def main():
 
+    args = parse_args()
     config = Config(connect_timeout=60, read_timeout=60)
-    session = boto3.Session(profile_name=None if len(sys.argv) < 2 else sys.argv[1])
-    amis = {}
-    f = open("ami.yaml","w")
-    for region in get_regions(session.client('ec2', region_name= 'us-east-1', config= config)):
-    	amis[region] = {"AMI": bastion_ami(session, config, region)}
+    session = boto3.Session(profile_name=args.profile)
+    ApiMetrics(args.metrics).install(session).print_summary_at_exit()
+    if args.rate_limit:
+        RateLimiter(parse_rates(args.rate)).install(session).print_summary_at_exit()
+
+    regions = get_regions(session.client('ec2', region_name= 'us-east-1', config= config))
+
+    cache = load_cache(args.cache)
+    # Each architecture's filters have their own cache entries
+    entries = dict((key, cache['entries'].setdefault(filter_key(filters, exclude_names), {}))
+        for key, filters, exclude_names in ARCHITECTURES)
+    template_amis = read_ami_map(args.template) if args.template else {}
+
+    now = time.time()
+    if args.changed_only:
+        refresh = [region for region in regions
+            if any(is_stale(entries[key].get(region), now, args.ttl)
+                or (args.template and template_amis.get(region, {}).get(key) != entries[key][region]['ImageId'])
+                for key, _, _ in ARCHITECTURES)]
+    else:
+        refresh = regions
+
+    start = time.time()
+    found = discover_amis(get_clients(session, config, refresh), args.workers)
+    sys.stderr.write('Refreshed {} of {} regions in {:.2f}s\n'.format(len(found), len(regions), time.time() - start))
+
+    for region, entry in found.items():
+        for key, ami in entry.items():
+            entries[key][region] = {'ImageId': ami, 'Checked': now}
+    save_cache(args.cache, cache)
+
+    # Everything below is built from the cache so the template and ami.yaml always agree with it
+    amis = CommentedMap()
+    for region in sorted(regions):
+        entry = ami_entry(dict((key, entries[key][region]['ImageId']) for key, _, _ in ARCHITECTURES if region in entries[key]))
+        if entry:
+            amis[region] = entry
+
+    if args.template:
+        for region, key in patch_ami_map(args.template, amis):
+            sys.stderr.write('Updated {} AMIMap {} {}: {} -> {}\n'.format(os.path.basename(args.template), region, key,
+                template_amis.get(region, {}).get(key), amis[region][key]))
 
     yaml=YAML()
     yaml.default_flow_style = False
@@ -61,9 +328,9 @@ def main():
     yaml.dump(amis, sys.stdout)
 
     #Dump AMI list in yaml format to a file
-    yaml.dump(amis, f)
+    with open("ami.yaml","w") as f:
+        yaml.dump(amis, f)
     
 if __name__ == '__main__':
     main()
 
-
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+""" Benchmark test.py and amis.py against the in-process stand-in in fakeaws.py
+
+Run with: python bench.py [--regions 20] [--scale 0.005] [--scenario all] [--cfn-rate 4] [--no-rate-limit]
+
+The calls are paced by the same rate limiter test.py and amis.py install by default.
+
+Calls that run out of retries leave the harness with less work to do, so a scenario that
+had any is reported as failed and the benchmark exits non-zero.
+"""
+
+import argparse, os, sys
+
+import amis, fakeaws, test
+from journal import RunJournal
+from ratelimit import RateLimiter
+from regions import RegionContext
+from watcher import StackWatcher
+
+GITHUB = { 'user': 'bench', 'repo': 'bench', 'token': 'bench' }
+
+def quiet(function, *args, **kwargs):
+    """ Run a harness function with its progress output thrown away
+    """
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        return function(*args, **kwargs)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+def bench_amis(backend, workers):
+    session = fakeaws.FakeSession(backend)
+    regions = amis.get_regions(session.client('ec2', region_name='us-east-1'))
+    stderr = sys.stderr
+    sys.stderr = open(os.devnull, 'w')
+    try:
+        amis.discover_amis(amis.get_clients(session, None, regions), workers)
+    finally:
+        sys.stderr.close()
+        sys.stderr = stderr
+
+def bench_matrix(backend, shared):
+    context = RegionContext(fakeaws.FakeSession(backend))
+    watcher = StackWatcher(sleep=backend.clock.sleep, clock=backend.clock.time)
+    journal = RunJournal()
+    key_pairs = quiet(test.ensure_foundation, context, journal)
+    quiet(test.run_matrix, context, watcher, sorted(test.STACK_OPTIONS), GITHUB, key_pairs, shared, None, journal)
+    quiet(test.remove_keypairs, context, key_pairs)
+    quiet(test.remove_app_buckets, context, journal.buckets())
+
+# Name, default clock scale and runner. Thread pools take about 0.1 real seconds to shut down,
+# so the short amis runs use a slower clock to keep that out of the simulated time
+SCENARIOS = [
+    ('amis-serial', 0.05, lambda backend: bench_amis(backend, 1)),
+    ('amis-concurrent', 0.05, lambda backend: bench_amis(backend, amis.DEFAULT_WORKERS)),
+    ('matrix', 0.005, lambda backend: bench_matrix(backend, False)),
+    ('matrix-shared', 0.005, lambda backend: bench_matrix(backend, True)),
+]
+
+def report(name, backend, seconds):
+    failed = sum(backend.failures.values())
+    print('{}: {:.0f} simulated seconds, {} calls, {} throttled, {} retries, {} failed{}'.format(
+        name, seconds, backend.total_calls(), backend.throttles, backend.retries, failed,
+        ' - FAILED, the time is not comparable' if failed else ''))
+    for (service, operation), count in sorted(backend.calls.items(), key=lambda item: -item[1]):
+        failures = backend.failures.get((service, operation))
+        print('    {:<16} {:<28} {:>7}{}'.format(service, operation, count, ' {} failed'.format(failures) if failures else ''))
+    return failed
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark the test harness against a simulated AWS')
+    parser.add_argument('--regions', type=int, default=len(fakeaws.REGIONS), help='Number of simulated regions')
+    parser.add_argument('--scale', type=float, default=None, help='Real seconds per simulated second, overrides each scenario default')
+    parser.add_argument('--scenario', default='all', choices=[ 'all' ] + [ name for name, _, _ in SCENARIOS ])
+    parser.add_argument('--no-rate-limit', dest='rate_limit', action='store_false', help='Do not pace the calls with the rate limiter the harness installs')
+    parser.add_argument('--cfn-rate', type=float, default=fakeaws.DEFAULTS['rate']['cloudformation'], help='CloudFormation calls per second per region before throttling')
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    failed = []
+    for name, scale, run in SCENARIOS:
+        if args.scenario not in ('all', name):
+            continue
+        rate = dict(fakeaws.DEFAULTS['rate'], cloudformation=args.cfn_rate)
+        clock = fakeaws.ScaledClock(args.scale or scale)
+        limiter = RateLimiter(clock=clock.time, sleep=clock.sleep, stream=sys.stdout) if args.rate_limit else None
+        backend = fakeaws.Backend(clock, fakeaws.REGIONS[:args.regions], limiter=limiter, rate=rate)
+        start = backend.clock.time()
+        run(backend)
+        if report(name, backend, backend.clock.time() - start):
+            failed.append(name)
+        if limiter:
+            limiter.summary()
+    if failed:
+        sys.exit('Calls ran out of retries in: {}'.format(', '.join(failed)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+
+""" Publish the templates to the deploy bucket, uploading only the ones that changed
+
+Run with: python bin/deploy.py awslabs-startup-kit-templates-deploy-v3 startup [--workers 8] [--force] [--dry-run]
+
+Each template's MD5 is compared with the ETag S3 holds for its key, which is the MD5 of
+a single part upload, so unchanged templates do not add a version to the bucket. The
+version id of every published template is written to the manifest.
+"""
+
+import boto3, botocore, argparse, hashlib, json, os, sys, time
+from multiprocessing.pool import ThreadPool
+from botocore.client import Config
+
+ROOT=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+MANIFEST_FILE='deploy-manifest.json'
+MANIFEST_VERSION=1
+DEFAULT_WORKERS=8
+
+def bucket_policy(bucket):
+    return json.dumps({
+        'Version': '2012-10-17',
+        'Statement': [
+            { 'Effect': 'Allow', 'Principal': '*', 'Action': [ 's3:GetObject', 's3:GetObjectVersion' ], 'Resource': 'arn:aws:s3:::{}/*'.format(bucket) },
+            { 'Effect': 'Allow', 'Principal': '*', 'Action': [ 's3:ListBucket', 's3:GetBucketVersioning' ], 'Resource': 'arn:aws:s3:::{}'.format(bucket) },
+        ],
+    })
+
+def template_files(root):
+    """ Map each S3 key to its local path, the top level *.yml files and everything under templates/
+    """
+    files = {}
+    for name in os.listdir(root):
+        if name.endswith('.yml') and os.path.isfile(os.path.join(root, name)):
+            files[name] = os.path.join(root, name)
+    templates = os.path.join(root, 'templates')
+    for directory, _, names in os.walk(templates):
+        for name in names:
+            path = os.path.join(directory, name)
+            files['templates/' + os.path.relpath(path, templates).replace(os.sep, '/')] = path
+    return files
+
+def file_md5(path):
+    with open(path, 'rb') as f:
+        return hashlib.md5(f.read()).hexdigest()
+
+def ensure_bucket(client, bucket, region):
+    """ Create the bucket if needed and make sure it is public and versioned
+    """
+    try:
+        client.head_bucket(Bucket=bucket)
+    except botocore.exceptions.ClientError:
+        if region == 'us-east-1':
+            client.create_bucket(Bucket=bucket)
+        else:
+            client.create_bucket(Bucket=bucket, CreateBucketConfiguration={ 'LocationConstraint': region })
+        print('Created bucket: {}'.format(bucket))
+    client.put_bucket_policy(Bucket=bucket, Policy=bucket_policy(bucket))
+    client.put_bucket_versioning(Bucket=bucket, VersioningConfiguration={ 'Status': 'Enabled' })
+
+def remote_etags(client, bucket):
+    """ Map the top level keys and the keys under templates/ to their ETags without the quotes
+    """
+    etags = {}
+    for kwargs in ({ 'Delimiter': '/' }, { 'Prefix': 'templates/' }):
+        for page in client.get_paginator('list_objects_v2').paginate(Bucket=bucket, **kwargs):
+            for item in page.get('Contents', []):
+                etags[item['Key']] = item['ETag'].strip('"')
+    return etags
+
+def load_manifest(path, bucket):
+    """ Load the manifest of a previous publish to the same bucket, anything else is treated as empty
+    """
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+        if manifest.get('version') == MANIFEST_VERSION and manifest.get('bucket') == bucket:
+            return manifest
+    except (IOError, OSError, ValueError):
+        pass
+    return { 'version': MANIFEST_VERSION, 'bucket': bucket, 'templates': {} }
+
+def save_manifest(path, manifest):
+    """ Write the manifest next to its final location first so an interrupted run cannot corrupt it
+    """
+    tmp = '{}.tmp'.format(path)
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.rename(tmp, path)
+
+def upload(job):
+    client, bucket, key, path, md5 = job
+    with open(path, 'rb') as f:
+        response = client.put_object(Bucket=bucket, Key=key, Body=f)
+    if response['ETag'].strip('"') != md5:
+        raise RuntimeError('Upload of {} changed on the way, S3 has ETag {}'.format(key, response['ETag']))
+    return key, response.get('VersionId')
+
+def publish(client, bucket, files, manifest, workers, force=False, dry_run=False):
+    """ Upload the changed files and return the keys that were uploaded
+
+    Keys that are unchanged keep the version id recorded in the manifest, one missing from
+    it is looked up with head_object.
+    """
+    hashes = dict((key, file_md5(path)) for key, path in files.items())
+    etags = remote_etags(client, bucket)
+    published = manifest['templates']
+
+    changed = sorted(key for key in files if force or etags.get(key) != hashes[key])
+    for key in sorted(set(files) - set(changed)):
+        entry = published.get(key)
+        if entry is None or entry.get('md5') != hashes[key] or not entry.get('version_id'):
+            version_id = None if dry_run else client.head_object(Bucket=bucket, Key=key).get('VersionId')
+            published[key] = { 'md5': hashes[key], 'version_id': version_id }
+
+    if dry_run:
+        for key in changed:
+            print('Would upload: {}'.format(key))
+        return changed
+
+    pool = ThreadPool(max(1, min(workers, len(changed))))
+    try:
+        for key, version_id in pool.imap_unordered(upload, [ (client, bucket, key, files[key], hashes[key]) for key in changed ]):
+            published[key] = { 'md5': hashes[key], 'version_id': version_id }
+            print('Uploaded: {} version: {}'.format(key, version_id))
+    finally:
+        pool.close()
+        pool.join()
+
+    for key in set(published) - set(files):
+        del published[key]
+    return changed
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Publish the templates to the deploy bucket')
+    parser.add_argument('bucket', help='Deploy bucket name')
+    parser.add_argument('profile', help='AWS CLI profile name')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help='Concurrent uploads')
+    parser.add_argument('--manifest', default=MANIFEST_FILE, help='File the published version ids are written to')
+    parser.add_argument('--force', action='store_true', help='Upload every template even if S3 already has it')
+    parser.add_argument('--dry-run', action='store_true', help='Only list the templates that would be uploaded')
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    session = boto3.Session(profile_name=args.profile)
+    client = session.client('s3', config=Config(max_pool_connections=args.workers))
+
+    start = time.time()
+    if not args.dry_run:
+        ensure_bucket(client, args.bucket, session.region_name or 'us-east-1')
+    files = template_files(ROOT)
+    manifest = load_manifest(args.manifest, args.bucket)
+    changed = publish(client, args.bucket, files, manifest, args.workers, args.force, args.dry_run)
+    if not args.dry_run:
+        save_manifest(args.manifest, manifest)
+    sys.stderr.write('{} of {} templates uploaded in {:.2f}s\n'.format(0 if args.dry_run else len(changed), len(files), time.time() - start))
+
+if __name__ == '__main__':
+    main()
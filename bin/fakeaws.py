@@ -0,0 +1,428 @@
+""" In-process stand-in for the AWS calls made by test.py and amis.py
+
+FakeSession can be passed anywhere the scripts take a boto3 session. Every call
+waits out an injected latency on a scaled clock, can be throttled per service and
+region, and stacks move from IN_PROGRESS to COMPLETE after a configurable time, so
+the harness can be benchmarked without an AWS account.
+
+Only the calls the two scripts make are simulated. Fake stacks have no resources or
+events, so there is no describe_stack_events and timeline.py cannot profile them.
+"""
+
+import random, threading, time
+from botocore.exceptions import ClientError
+
+REGIONS = [
+    'us-east-1', 'us-east-2', 'us-west-1', 'us-west-2', 'ca-central-1',
+    'eu-west-1', 'eu-west-2', 'eu-west-3', 'eu-central-1', 'eu-north-1',
+    'ap-south-1', 'ap-northeast-1', 'ap-northeast-2', 'ap-northeast-3',
+    'ap-southeast-1', 'ap-southeast-2', 'sa-east-1', 'eu-south-1',
+    'me-south-1', 'af-south-1',
+]
+
+# Regions with a single availability zone, the harness skips these
+SINGLE_AZ_REGIONS = [ 'ap-northeast-3' ]
+
+DEFAULTS = {
+    # Simulated seconds per call, keyed by 'service' or 'service.operation'
+    'latency': { 'default': 0.05, 'cloudformation': 0.1, 's3.copy': 0.5, 'ec2.describe_images': 1.0 },
+    # Sustained calls per simulated second per service and region, None disables throttling
+    'rate': { 'cloudformation': 4, 'ec2': 20 },
+    # Seconds a stack spends in progress, keyed by template file name
+    'stack_seconds': {
+        'create': { 'default': 600, 'vpc.cfn.yml': 240, 'vpc-bastion.cfn.yml': 420 },
+        'delete': { 'default': 300 },
+    },
+    # Template file names whose stacks fail to create
+    'fail_templates': [],
+    'images_per_region': 2500,
+    'artifact_objects': 2500,
+    'repository_images': 150,
+    'max_retries': 4,
+}
+
+# CPU time used by the process, the harness's own work is not counted as simulated time
+process_time = getattr(time, 'process_time', None) or time.clock
+
+class ScaledClock(object):
+    """ Wall clock running scale times slower than simulated time, so threads overlap as they would for real
+    """
+
+    def __init__(self, scale=0.01):
+        self.scale = scale
+        self.origin = time.time() - process_time()
+
+    def time(self):
+        return (time.time() - process_time() - self.origin) / self.scale
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds * self.scale)
+
+def client_error(code, operation, message=''):
+    return ClientError({ 'Error': { 'Code': code, 'Message': message or code } }, operation)
+
+class Backend(object):
+    """ Shared state behind every FakeSession client, with the call counters the benchmark reports
+    """
+
+    def __init__(self, clock=None, regions=REGIONS, limiter=None, **overrides):
+        self.clock = clock or ScaledClock()
+        # A ratelimit.RateLimiter paced on the simulated clock, told about every attempt the way its botocore hooks are
+        self.limiter = limiter
+        self.regions = list(regions)
+        self.options = dict(DEFAULTS)
+        self.options.update(overrides)
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.throttles = 0
+        self.retries = 0
+        # Calls that ran out of retries, keyed by (service, operation)
+        self.failures = {}
+        self.buckets = {}
+        self.key_pairs = {}
+        self.repositories = {}
+        self.stacks = {}
+        self.stack_order = []
+        self.tokens = {}
+        # Built up front so generating them is not timed as part of a describe_images call
+        self.images = dict((region, self._make_images()) for region in self.regions)
+
+    def _make_images(self):
+        names = [ 'amzn-ami-hvm-{}-x86_64-gp2', 'amzn2-ami-hvm-{}-x86_64-gp2', 'amzn-ami-{}-amazon-ecs-optimized' ]
+        return [ {
+            'ImageId': 'ami-{:08x}'.format(i),
+            'Name': names[i % len(names)].format(i),
+            'CreationDate': '2018-{:02d}-{:02d}T00:00:{:02d}.000Z'.format(i % 12 + 1, i % 28 + 1, i % 60),
+        } for i in range(self.options['images_per_region']) ]
+
+    def latency(self, service, operation):
+        latency = self.options['latency']
+        return latency.get('{}.{}'.format(service, operation), latency.get(service, latency['default']))
+
+    def _take_token(self, service, region):
+        """ Token bucket per service and region, refilled at the configured rate
+        """
+        rate = self.options['rate'].get(service)
+        if rate is None:
+            return True
+        now = self.clock.time()
+        with self.lock:
+            tokens, updated = self.tokens.get((service, region), (rate, now))
+            tokens = min(rate, tokens + (now - updated) * rate)
+            if tokens < 1:
+                self.tokens[(service, region)] = (tokens, now)
+                return False
+            self.tokens[(service, region)] = (tokens - 1, now)
+            return True
+
+    def call(self, service, operation, region):
+        """ Account for one API call, retrying throttled attempts the way botocore does
+        """
+        for attempt in range(self.options['max_retries'] + 1):
+            with self.lock:
+                key = (service, operation)
+                self.calls[key] = self.calls.get(key, 0) + 1
+                if attempt:
+                    self.retries += 1
+            if self.limiter:
+                self.limiter.acquire(service, region)
+            self.clock.sleep(self.latency(service, operation))
+            if self._take_token(service, region):
+                if self.limiter:
+                    self.limiter.succeeded(service, region)
+                return
+            with self.lock:
+                self.throttles += 1
+            if self.limiter:
+                self.limiter.throttled(service, region)
+            self.clock.sleep(random.uniform(0, 2 ** attempt))
+        with self.lock:
+            self.failures[(service, operation)] = self.failures.get((service, operation), 0) + 1
+        raise client_error('Throttling', operation, 'Rate exceeded')
+
+    def total_calls(self):
+        return sum(self.calls.values())
+
+class FakeSession(object):
+    """ Stands in for boto3.Session
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def client(self, service, region_name=None, config=None):
+        return CLIENTS[service](self.backend, region_name or 'us-east-1')
+
+class FakePaginator(object):
+    """ Calls a paginated fake operation until it stops returning NextToken
+    """
+
+    def __init__(self, operation):
+        self.operation = operation
+
+    def paginate(self, **kwargs):
+        page_size = kwargs.pop('PaginationConfig', {}).get('PageSize')
+        if page_size:
+            kwargs['MaxResults'] = page_size
+        while True:
+            page = self.operation(**kwargs)
+            yield page
+            if 'NextToken' not in page:
+                return
+            kwargs['NextToken'] = page['NextToken']
+
+def page(items, kwargs, default_size):
+    """ Slice items for a NextToken style page
+    """
+    start = int(kwargs.get('NextToken', 0))
+    size = kwargs.get('MaxResults', default_size)
+    result = { 'items': items[start:start + size] }
+    if start + size < len(items):
+        result['NextToken'] = str(start + size)
+    return result
+
+class FakeClient(object):
+
+    service = None
+
+    def __init__(self, backend, region):
+        self.backend = backend
+        self.region = region
+
+    def _call(self, operation):
+        self.backend.call(self.service, operation, self.region)
+
+    def get_paginator(self, operation):
+        return FakePaginator(getattr(self, operation))
+
+class FakeEc2(FakeClient):
+
+    service = 'ec2'
+
+    def describe_regions(self):
+        self._call('describe_regions')
+        return { 'Regions': [ { 'RegionName': region } for region in self.backend.regions ] }
+
+    def describe_availability_zones(self):
+        self._call('describe_availability_zones')
+        count = 1 if self.region in SINGLE_AZ_REGIONS else 3
+        return { 'AvailabilityZones': [ { 'ZoneName': '{}{}'.format(self.region, 'abc'[i]) } for i in range(count) ] }
+
+    def create_key_pair(self, KeyName):
+        self._call('create_key_pair')
+        self.backend.key_pairs[(self.region, KeyName)] = True
+        return { 'KeyName': KeyName, 'KeyMaterial': 'fake-key-material' }
+
+    def delete_key_pair(self, KeyName):
+        self._call('delete_key_pair')
+        self.backend.key_pairs.pop((self.region, KeyName), None)
+        return {}
+
+    def describe_key_pairs(self, KeyNames):
+        self._call('describe_key_pairs')
+        for name in KeyNames:
+            if (self.region, name) not in self.backend.key_pairs:
+                raise client_error('InvalidKeyPair.NotFound', 'DescribeKeyPairs')
+        return { 'KeyPairs': [ { 'KeyName': name } for name in KeyNames ] }
+
+    def describe_vpcs(self, **kwargs):
+        self._call('describe_vpcs')
+        return { 'Vpcs': [ { 'VpcId': 'vpc-default' } ] }
+
+    def describe_addresses(self, **kwargs):
+        self._call('describe_addresses')
+        return { 'Addresses': [] }
+
+    def describe_nat_gateways(self, **kwargs):
+        self._call('describe_nat_gateways')
+        return { 'NatGateways': [] }
+
+    def describe_images(self, **kwargs):
+        self._call('describe_images')
+        result = page(self.backend.images[self.region], kwargs, 1000000)
+        response = { 'Images': result['items'] }
+        if 'NextToken' in result:
+            response['NextToken'] = result['NextToken']
+        return response
+
+class FakeS3(FakeClient):
+
+    service = 's3'
+
+    def head_bucket(self, Bucket):
+        self._call('head_bucket')
+        if Bucket not in self.backend.buckets:
+            raise client_error('404', 'HeadObject')
+        return {}
+
+    def create_bucket(self, Bucket, **kwargs):
+        self._call('create_bucket')
+        self.backend.buckets.setdefault(Bucket, [])
+        return {}
+
+    def delete_bucket(self, Bucket):
+        self._call('delete_bucket')
+        if self.backend.buckets.get(Bucket):
+            raise client_error('BucketNotEmpty', 'DeleteBucket')
+        self.backend.buckets.pop(Bucket, None)
+        return {}
+
+    def copy(self, CopySource, Bucket, Key):
+        self._call('copy')
+        self.backend.buckets.setdefault(Bucket, []).append({ 'Key': Key, 'VersionId': 'null' })
+
+    def put_object_acl(self, **kwargs):
+        self._call('put_object_acl')
+        return {}
+
+    def list_object_versions(self, Bucket, NextToken=None, MaxResults=1000):
+        """ Pages by the last key and version seen, like S3's markers, so deleting between pages skips nothing
+        """
+        self._call('list_object_versions')
+        versions = sorted(self.backend.buckets.get(Bucket, []), key=lambda item: (item['Key'], item['VersionId']))
+        if NextToken is not None:
+            marker = tuple(NextToken.split('|', 1))
+            versions = [ item for item in versions if (item['Key'], item['VersionId']) > marker ]
+        response = { 'Versions': versions[:MaxResults] }
+        if len(versions) > MaxResults:
+            last = versions[MaxResults - 1]
+            response['NextToken'] = '{}|{}'.format(last['Key'], last['VersionId'])
+        return response
+
+    def delete_objects(self, Bucket, Delete):
+        self._call('delete_objects')
+        if len(Delete['Objects']) > 1000:
+            raise client_error('MalformedXML', 'DeleteObjects')
+        gone = set((item['Key'], item.get('VersionId')) for item in Delete['Objects'])
+        with self.backend.lock:
+            self.backend.buckets[Bucket] = [ item for item in self.backend.buckets.get(Bucket, []) if (item['Key'], item['VersionId']) not in gone ]
+        return {}
+
+class FakeEcr(FakeClient):
+
+    service = 'ecr'
+
+    def list_images(self, repositoryName, **kwargs):
+        self._call('list_images')
+        result = page(list(self.backend.repositories.get(repositoryName, [])), kwargs, 100)
+        response = { 'imageIds': result['items'] }
+        if 'NextToken' in result:
+            response['NextToken'] = result['NextToken']
+        return response
+
+    def batch_delete_image(self, repositoryName, imageIds):
+        self._call('batch_delete_image')
+        if len(imageIds) > 100:
+            raise client_error('InvalidParameterException', 'BatchDeleteImage')
+        gone = set(image['imageDigest'] for image in imageIds)
+        with self.backend.lock:
+            self.backend.repositories[repositoryName] = [ image for image in self.backend.repositories.get(repositoryName, []) if image['imageDigest'] not in gone ]
+        return { 'imageIds': imageIds, 'failures': [] }
+
+class FakeServiceQuotas(FakeClient):
+
+    service = 'service-quotas'
+
+    def get_service_quota(self, ServiceCode, QuotaCode):
+        self._call('get_service_quota')
+        raise client_error('NoSuchResourceException', 'GetServiceQuota')
+
+class FakeCloudFormation(FakeClient):
+
+    service = 'cloudformation'
+
+    def _stack_seconds(self, action, template):
+        seconds = self.backend.options['stack_seconds'][action]
+        return seconds.get(template, seconds['default'])
+
+    def _status(self, stack):
+        """ Work out the stack status from how long ago its last action started
+        """
+        if stack['action'] is None:
+            return stack['status']
+        if self.backend.clock.time() - stack['started'] < stack['seconds']:
+            return '{}_IN_PROGRESS'.format(stack['action'])
+        failed = stack['action'] == 'CREATE' and stack['template'] in self.backend.options['fail_templates']
+        stack['status'] = 'ROLLBACK_COMPLETE' if failed else '{}_COMPLETE'.format(stack['action'])
+        stack['action'] = None
+        return stack['status']
+
+    def _find(self, name, operation):
+        for stack_id in reversed(self.backend.stack_order):
+            stack = self.backend.stacks[stack_id]
+            if stack['region'] == self.region and name in (stack_id, stack['name']):
+                if name == stack_id or self._status(stack) != 'DELETE_COMPLETE':
+                    return stack
+        raise client_error('ValidationError', operation, 'Stack with id {} does not exist'.format(name))
+
+    def create_stack(self, StackName, TemplateURL, Parameters, **kwargs):
+        self._call('create_stack')
+        template = TemplateURL.rsplit('/', 1)[1]
+        stack_id = 'arn:aws:cloudformation:{}:123456789012:stack/{}/{:012x}'.format(self.region, StackName, len(self.backend.stack_order))
+        outputs = [ { 'OutputKey': 'Name', 'OutputValue': StackName } ]
+        if template.startswith('vpc-bastion'):
+            outputs.append({ 'OutputKey': 'VpcStackName', 'OutputValue': '{}-VpcStack'.format(StackName) })
+        if 'fargate' in template:
+            outputs.append({ 'OutputKey': 'FargateStackName', 'OutputValue': StackName })
+            self.backend.buckets['{}-artifacts'.format(StackName)] = [ { 'Key': 'artifact-{}'.format(i), 'VersionId': str(i % 3) } for i in range(self.backend.options['artifact_objects']) ]
+            self.backend.repositories['{}-repository'.format(StackName)] = [ { 'imageDigest': 'sha256:{:x}'.format(i) } for i in range(self.backend.options['repository_images']) ]
+
+        with self.backend.lock:
+            self.backend.stacks[stack_id] = {
+                'name': StackName,
+                'region': self.region,
+                'template': template,
+                'outputs': outputs,
+                'action': 'CREATE',
+                'status': None,
+                'started': self.backend.clock.time(),
+                'seconds': self._stack_seconds('create', template),
+            }
+            self.backend.stack_order.append(stack_id)
+        return { 'StackId': stack_id }
+
+    def delete_stack(self, StackName):
+        self._call('delete_stack')
+        stack = self._find(StackName, 'DeleteStack')
+        if self._status(stack) != 'DELETE_COMPLETE':
+            stack['action'] = 'DELETE'
+            stack['started'] = self.backend.clock.time()
+            stack['seconds'] = self._stack_seconds('delete', stack['template'])
+        return {}
+
+    def describe_stacks(self, StackName):
+        self._call('describe_stacks')
+        stack = self._find(StackName, 'DescribeStacks')
+        stack_id = [ stack_id for stack_id, found in self.backend.stacks.items() if found is stack ][0]
+        return { 'Stacks': [ { 'StackId': stack_id, 'StackName': stack['name'], 'StackStatus': self._status(stack), 'Outputs': stack['outputs'] } ] }
+
+    def describe_stack_resource(self, StackName, LogicalResourceId):
+        self._call('describe_stack_resource')
+        stack = self._find(StackName, 'DescribeStackResource')
+        suffix = { 'CodePipelineArtifactBucket': 'artifacts', 'EcrDockerRepository': 'repository' }[LogicalResourceId]
+        return { 'StackResourceDetail': { 'LogicalResourceId': LogicalResourceId, 'PhysicalResourceId': '{}-{}'.format(stack['name'], suffix) } }
+
+    def list_stacks(self, StackStatusFilter=None, NextToken=None):
+        self._call('list_stacks')
+        summaries = []
+        for stack_id in reversed(self.backend.stack_order):
+            stack = self.backend.stacks[stack_id]
+            if stack['region'] != self.region:
+                continue
+            status = self._status(stack)
+            if StackStatusFilter is None or status in StackStatusFilter:
+                summaries.append({ 'StackId': stack_id, 'StackName': stack['name'], 'StackStatus': status })
+        result = page(summaries, { 'NextToken': NextToken or 0 }, 100)
+        response = { 'StackSummaries': result['items'] }
+        if 'NextToken' in result:
+            response['NextToken'] = result['NextToken']
+        return response
+
+CLIENTS = {
+    'ec2': FakeEc2,
+    's3': FakeS3,
+    'ecr': FakeEcr,
+    'service-quotas': FakeServiceQuotas,
+    'cloudformation': FakeCloudFormation,
+}
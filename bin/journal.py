@@ -0,0 +1,113 @@
+""" Durable journal of what a test.py run has created
+
+Every key pair, bucket, stack and stack phase is appended as a JSON line and synced to
+disk before the run moves on, so an interrupted run can be resumed or cleaned up later.
+
+Stack phases, in order: creating, created, deleting, deleted. A journal without a path
+keeps its entries in memory only.
+"""
+
+import json, os, threading, time
+
+class RunJournal(object):
+    """ Append only record of one harness run, replayed to find what is still out there
+    """
+
+    def __init__(self, path=None, fresh=False):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = [] if fresh else self._load()
+        self.out = None
+        if path:
+            # Rewriting drops a last line cut short by the interruption, everything before it is intact
+            self.out = open(path, 'w')
+            for entry in self.entries:
+                self.out.write(json.dumps(entry, sort_keys=True) + '\n')
+            self.out.flush()
+
+    def _load(self):
+        entries = []
+        if self.path is None:
+            return entries
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        break
+        except (IOError, OSError):
+            pass
+        return entries
+
+    def record(self, event, **fields):
+        entry = dict(fields, event=event, time=time.time())
+        with self.lock:
+            self.entries.append(entry)
+            if self.out:
+                self.out.write(json.dumps(entry, sort_keys=True) + '\n')
+                self.out.flush()
+                os.fsync(self.out.fileno())
+
+    def stack(self, stack_id, stack_type, region, phase, status=None, ok=None, foundation=False):
+        self.record('stack', stack_id=stack_id, stack_type=stack_type, region=region, phase=phase,
+            status=status, ok=ok, foundation=foundation)
+
+    def close(self):
+        with self.lock:
+            if self.out:
+                self.out.close()
+                self.out = None
+
+    def _of(self, event):
+        with self.lock:
+            return [ entry for entry in self.entries if entry['event'] == event ]
+
+    @property
+    def started(self):
+        return bool(self._of('run'))
+
+    @property
+    def finished(self):
+        return bool(self._of('finished'))
+
+    def options(self):
+        """ The options the run was started with
+        """
+        runs = self._of('run')
+        return runs[0] if runs else {}
+
+    def key_pairs(self):
+        return dict((entry['region'], { 'KeyName': entry['key_name'] }) for entry in self._of('key_pair'))
+
+    def buckets(self):
+        return dict((entry['region'], entry['bucket']) for entry in self._of('bucket'))
+
+    def stacks(self):
+        """ The latest state of every stack, oldest first
+        """
+        stacks = {}
+        order = []
+        for entry in self._of('stack'):
+            if entry['stack_id'] not in stacks:
+                order.append(entry['stack_id'])
+                stacks[entry['stack_id']] = {}
+            state = stacks[entry['stack_id']]
+            # A deleted stack's create status is still its create status
+            if entry['phase'] == 'created':
+                state['create_ok'] = entry['ok']
+            state.update((key, value) for key, value in entry.items() if key not in ('event', 'time'))
+        return [ stacks[stack_id] for stack_id in order ]
+
+    def results(self):
+        """ {(stack_type, region): {action: status}} of the matrix entries
+        """
+        results = {}
+        for entry in self._of('result'):
+            results.setdefault((entry['stack_type'], entry['region']), {})[entry['action']] = entry['status']
+        return results
+
+    def done(self):
+        """ The (stack_type, region) of every matrix entry that finished
+        """
+        return set((entry['stack_type'], entry['region']) for entry in self._of('entry_done'))
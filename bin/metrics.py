@@ -0,0 +1,147 @@
+""" Per API call metrics for test.py and amis.py
+
+ApiMetrics hooks botocore's before-parameter-build, needs-retry and after-call events on a
+boto3 session, writes one JSON line per call and prints latency histograms at exit. Time a
+RateLimiter spent queueing the call is recorded as queued_ms, apart from latency_ms.
+"""
+
+import atexit, json, sys, threading, time
+
+THROTTLE_CODES = [ 'Throttling', 'ThrottlingException', 'ThrottledException', 'RequestLimitExceeded',
+    'TooManyRequestsException', 'RequestThrottled', 'SlowDown', 'RequestThrottledException' ]
+
+# Upper bounds, in milliseconds, of the latency histogram buckets
+BUCKETS = [ 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000 ]
+
+BAR_WIDTH=40
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def error_code(parsed):
+    if not isinstance(parsed, dict):
+        return None
+    return parsed.get('Error', {}).get('Code')
+
+class ApiMetrics(object):
+    """ Collects a record per API call made through the sessions it is installed on
+    """
+
+    def __init__(self, path=None, stream=sys.stderr):
+        self.path = path
+        self.stream = stream
+        self.lock = threading.Lock()
+        self.records = []
+        self.out = open(path, 'a') if path else None
+
+    def install(self, session):
+        """ Register on a boto3 session, clients created from it afterwards are measured
+        """
+        session.events.register('before-parameter-build', self._before_call)
+        session.events.register('needs-retry', self._needs_retry)
+        session.events.register('after-call', self._after_call)
+        session.events.register('after-call-error', self._after_call_error)
+        return self
+
+    def print_summary_at_exit(self):
+        atexit.register(self.close)
+        return self
+
+    def _before_call(self, model, context, **kwargs):
+        # after-call-error is not passed the model, so keep what it needs in the call context.
+        # Queueing the rate limiter did before the timer started is not part of the latency,
+        # whichever of the two was installed first.
+        context['metrics'] = {
+            'start': time.time(),
+            'queued': context.get('rate_limit_queued', 0.0),
+            'service': model.service_model.service_name,
+            'operation': model.name,
+            'throttles': 0,
+        }
+
+    def _needs_retry(self, response=None, request_dict=None, **kwargs):
+        # Called after every attempt, count the attempts that were throttled
+        if response is None or request_dict is None:
+            return None
+        metrics = request_dict.get('context', {}).get('metrics')
+        if metrics is not None and error_code(response[1]) in THROTTLE_CODES:
+            metrics['throttles'] += 1
+        return None
+
+    def _after_call(self, model, context, parsed=None, http_response=None, **kwargs):
+        retries = parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0) if isinstance(parsed, dict) else 0
+        self._record(context, error_code(parsed), retries)
+
+    def _after_call_error(self, context, exception=None, **kwargs):
+        self._record(context, type(exception).__name__, 0)
+
+    def _record(self, context, error, retries):
+        metrics = context.pop('metrics', None)
+        if metrics is None:
+            return
+        queued = context.get('rate_limit_queued', 0.0)
+        elapsed = time.time() - metrics['start'] - (queued - metrics['queued'])
+        record = {
+            'time': metrics['start'],
+            'service': metrics['service'],
+            'operation': metrics['operation'],
+            'region': context.get('client_region'),
+            'latency_ms': round(elapsed * 1000, 1),
+            'queued_ms': round(queued * 1000, 1),
+            'retries': retries,
+            'throttles': metrics['throttles'] + (1 if error in THROTTLE_CODES else 0),
+            'error': error,
+        }
+        with self.lock:
+            self.records.append(record)
+            if self.out:
+                self.out.write(json.dumps(record, sort_keys=True) + '\n')
+
+    def close(self):
+        """ Flush the JSON lines and print the summary, safe to call more than once
+        """
+        with self.lock:
+            if self.out:
+                self.out.close()
+                self.out = None
+            records = list(self.records)
+            self.records = []
+        if records:
+            self.summary(records)
+
+    def summary(self, records):
+        write = self.stream.write
+        write('\nAPI calls: {}  errors: {}  throttled attempts: {}  retries: {}\n'.format(len(records),
+            sum(1 for record in records if record['error']), sum(record['throttles'] for record in records),
+            sum(record['retries'] for record in records)))
+
+        by_operation = {}
+        by_region = {}
+        for record in records:
+            by_operation.setdefault((record['service'], record['operation']), []).append(record)
+            by_region.setdefault(record['region'], []).append(record)
+
+        write('\n{:<16} {:<32} {:>6} {:>6} {:>6} {:>8} {:>8} {:>8} {:>10}\n'.format(
+            'service', 'operation', 'calls', 'errors', 'thrtl', 'p50 ms', 'p90 ms', 'max ms', 'total s'))
+        for (service, operation), group in sorted(by_operation.items(), key=lambda item: -sum(record['latency_ms'] for record in item[1])):
+            latencies = [ record['latency_ms'] for record in group ]
+            write('{:<16} {:<32} {:>6} {:>6} {:>6} {:>8.0f} {:>8.0f} {:>8.0f} {:>10.1f}\n'.format(service, operation, len(group),
+                sum(1 for record in group if record['error']), sum(record['throttles'] for record in group),
+                percentile(latencies, 0.5), percentile(latencies, 0.9), max(latencies), sum(latencies) / 1000.0))
+
+        write('\n{:<16} {:>6} {:>6} {:>10}\n'.format('region', 'calls', 'thrtl', 'total s'))
+        for region, group in sorted(by_region.items(), key=lambda item: -len(item[1])):
+            write('{:<16} {:>6} {:>6} {:>10.1f}\n'.format(region, len(group), sum(record['throttles'] for record in group),
+                sum(record['latency_ms'] for record in group) / 1000.0))
+
+        counts = [ 0 ] * (len(BUCKETS) + 1)
+        for record in records:
+            index = 0
+            while index < len(BUCKETS) and record['latency_ms'] > BUCKETS[index]:
+                index += 1
+            counts[index] += 1
+        write('\nlatency histogram\n')
+        for index, count in enumerate(counts):
+            label = '<= {} ms'.format(BUCKETS[index]) if index < len(BUCKETS) else '> {} ms'.format(BUCKETS[-1])
+            write('{:>12} {:>6} {}\n'.format(label, count, '#' * int(round(BAR_WIDTH * count / float(max(counts))))))
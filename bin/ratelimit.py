@@ -0,0 +1,152 @@
+""" Throttle aware rate limiting of the AWS calls made by test.py and amis.py
+
+RateLimiter keeps a token bucket per service and region, shared by every thread and
+client of the sessions it is installed on. Each attempt takes a token first, waiting
+when the bucket is empty. A throttled attempt halves the bucket's rate, each successful
+one adds a little back, up to twice the starting rate, so every region settles just
+under the rate its API limits allow. Time spent waiting for tokens is reported at exit,
+and kept per call in the call context for ApiMetrics.
+"""
+
+import atexit, sys, threading, time
+from metrics import THROTTLE_CODES, error_code
+
+# Starting calls per second per region, the account level limits are shared by every caller
+RATES = { 'default': 10, 'cloudformation': 4, 'ec2': 20, 's3': 50, 'ecr': 10, 'service-quotas': 5 }
+
+MIN_RATE=0.5
+MAX_RATE_FACTOR=2.0
+# Multiplied into the rate when an attempt is throttled
+BACKOFF=0.5
+# Calls per second added back for each successful attempt
+RECOVERY=0.05
+# Throttles within this many seconds of a cut answer calls already in flight and do not cut again
+COOLDOWN=1.0
+
+def rate_option(value):
+    """ Parse a service=calls_per_second command line value, argparse reports the ValueError
+    """
+    service, _, rate = value.partition('=')
+    return service, float(rate)
+
+def parse_rates(options):
+    """ RATES with the (service, rate) pairs of rate_option applied on top
+    """
+    return dict(RATES, **dict(options or []))
+
+class TokenBucket(object):
+    """ Rate, tokens and counters of one service in one region, guarded by the limiter's lock
+    """
+
+    def __init__(self, rate, now):
+        self.rate = float(rate)
+        self.max_rate = self.rate * MAX_RATE_FACTOR
+        self.tokens = 1.0
+        self.updated = now
+        self.cut = None
+        self.calls = 0
+        self.throttles = 0
+        self.queued = 0.0
+        self.max_queued = 0.0
+        self.min_rate = self.rate
+
+    def refill(self, now):
+        self.tokens = min(max(1.0, self.rate), self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+class RateLimiter(object):
+    """ Paces the API calls made through the sessions it is installed on
+    """
+
+    def __init__(self, rates=None, clock=time.time, sleep=time.sleep, stream=sys.stderr):
+        self.rates = rates or RATES
+        self.clock = clock
+        self.sleep = sleep
+        self.stream = stream
+        self.lock = threading.Lock()
+        self.buckets = {}
+
+    def install(self, session):
+        """ Register on a boto3 session, clients created from it afterwards are rate limited
+        """
+        session.events.register('before-parameter-build', self._before_call)
+        session.events.register('needs-retry', self._needs_retry)
+        return self
+
+    def print_summary_at_exit(self):
+        atexit.register(self.summary)
+        return self
+
+    def _bucket(self, service, region, now):
+        key = (service, region)
+        if key not in self.buckets:
+            self.buckets[key] = TokenBucket(self.rates.get(service, self.rates['default']), now)
+        return self.buckets[key]
+
+    def acquire(self, service, region):
+        """ Take a token, waiting until one is due, and return the seconds waited
+        """
+        with self.lock:
+            now = self.clock()
+            bucket = self._bucket(service, region, now)
+            bucket.refill(now)
+            # Taking the token up front reserves a place in the queue, later callers wait behind it
+            bucket.tokens -= 1
+            wait = -bucket.tokens / bucket.rate if bucket.tokens < 0 else 0.0
+            bucket.calls += 1
+            bucket.queued += wait
+            bucket.max_queued = max(bucket.max_queued, wait)
+        if wait > 0:
+            self.sleep(wait)
+        return wait
+
+    def throttled(self, service, region):
+        with self.lock:
+            now = self.clock()
+            bucket = self._bucket(service, region, now)
+            bucket.throttles += 1
+            if bucket.cut is not None and now - bucket.cut < COOLDOWN:
+                return
+            bucket.refill(now)
+            bucket.rate = max(MIN_RATE, bucket.rate * BACKOFF)
+            bucket.min_rate = min(bucket.min_rate, bucket.rate)
+            bucket.cut = now
+
+    def succeeded(self, service, region):
+        with self.lock:
+            bucket = self._bucket(service, region, self.clock())
+            bucket.rate = min(bucket.max_rate, bucket.rate + RECOVERY)
+
+    def _before_call(self, model, context, **kwargs):
+        key = (model.service_model.service_name, context.get('client_region'))
+        context['rate_limit'] = key
+        context['rate_limit_queued'] = self.acquire(*key)
+
+    def _needs_retry(self, response=None, request_dict=None, **kwargs):
+        # Called after every attempt, a throttled one waits for a token again before it is retried
+        if response is None or request_dict is None:
+            return None
+        context = request_dict.get('context', {})
+        key = context.get('rate_limit')
+        if key is None:
+            return None
+        if error_code(response[1]) in THROTTLE_CODES:
+            self.throttled(*key)
+            context['rate_limit_queued'] += self.acquire(*key)
+        elif response[0].status_code < 500:
+            self.succeeded(*key)
+        return None
+
+    def summary(self):
+        with self.lock:
+            buckets = sorted(self.buckets.items(), key=lambda item: -item[1].queued)
+        if not buckets:
+            return
+        write = self.stream.write
+        write('\nrate limiter, queued {:.1f}s over {} calls\n'.format(sum(bucket.queued for _, bucket in buckets),
+            sum(bucket.calls for _, bucket in buckets)))
+        write('{:<16} {:<16} {:>6} {:>6} {:>10} {:>10} {:>8} {:>8}\n'.format(
+            'service', 'region', 'calls', 'thrtl', 'queued s', 'max ms', 'min/s', 'rate/s'))
+        for (service, region), bucket in buckets:
+            write('{:<16} {:<16} {:>6} {:>6} {:>10.1f} {:>10.0f} {:>8.1f} {:>8.1f}\n'.format(service, region, bucket.calls,
+                bucket.throttles, bucket.queued, bucket.max_queued * 1000, bucket.min_rate, bucket.rate))
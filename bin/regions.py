@@ -0,0 +1,51 @@
+""" Region discovery and per-region clients shared by a whole harness run
+
+RegionContext looks up the regions and their availability zones once and hands out one
+client per service and region, so the create, wait and cleanup steps reuse the same
+clients and their connection pools instead of building new ones every time around a loop.
+"""
+
+import threading
+
+HOME_REGION='us-east-1'
+
+class RegionContext(object):
+    """ Memoized regions, availability zones and clients for one boto3 session
+    """
+
+    def __init__(self, session, config=None, home_region=HOME_REGION):
+        self.session = session
+        self.config = config
+        self.home_region = home_region
+        # Sessions are not thread safe, every client is built under the lock
+        self.lock = threading.RLock()
+        self.clients = {}
+        self._regions = None
+        self._availability_zones = {}
+
+    def client(self, service, region=None):
+        """ The client for a service in a region, built on first use and reused after that
+        """
+        key = (service, region or self.home_region)
+        with self.lock:
+            if key not in self.clients:
+                self.clients[key] = self.session.client(service, region_name=key[1], config=self.config)
+            return self.clients[key]
+
+    def regions(self):
+        """ The region codes, looked up once
+        """
+        with self.lock:
+            if self._regions is None:
+                response = self.client('ec2').describe_regions()
+                self._regions = [ region['RegionName'] for region in response['Regions'] ]
+            return list(self._regions)
+
+    def availability_zones(self, region):
+        """ The zone names of a region, looked up once
+        """
+        with self.lock:
+            if region not in self._availability_zones:
+                response = self.client('ec2', region).describe_availability_zones()
+                self._availability_zones[region] = [ zone['ZoneName'] for zone in response['AvailabilityZones'] ]
+            return list(self._availability_zones[region])
@@ -1,10 +1,19 @@
 #!/usr/bin/env python
 
-""" Run test script with command: python test.py profile_name github_username github_repository token
+""" Run test script with command: python test.py profile_name github_username github_repository token [--shared-foundation] [--timeline-dir DIR]
+
+After an interruption: python test.py profile_name github_username github_repository token --resume
+                   or: python test.py profile_name --reap
 """
-import boto3, botocore, os, time, sys
-from os.path import expanduser
+import boto3, botocore, os, sys, argparse
+from multiprocessing.pool import ThreadPool
 from botocore.client import Config
+from metrics import ApiMetrics
+from ratelimit import RateLimiter, parse_rates, rate_option
+from journal import RunJournal
+from regions import RegionContext
+from watcher import StackWatcher, stack_name
+import timeline, validate
 
 TEST_APP_BUCKET_PREFIX='awslabs-startup-kit-templates-test-eb-v1-tmp-'
 TEST_APP_SOURCE_BUCKET='awslabs-startup-kit-templates-test-eb-v1'
@@ -20,27 +29,73 @@ FARGATE_RDS_TEMPLATE_URL='{}vpc-bastion-fargate-rds.cfn.yml'.format(TEMPLATE_URL
 VPC_TEMPLATE_URL='{}vpc.cfn.yml'.format(TEMPLATE_URL_PREFX)
 VPC_BASTION_TEMPLATE_URL='{}vpc-bastion.cfn.yml'.format(TEMPLATE_URL_PREFX)
 
-KEY_PAIR_PREFIX='sktemplates-test-'
+# Templates deployed on their own on top of a shared foundation
+DB_TEMPLATE_URL='{}templates/db.cfn.yml'.format(TEMPLATE_URL_PREFX)
+AURORA_TEMPLATE_URL='{}templates/aurora.cfn.yml'.format(TEMPLATE_URL_PREFX)
+EB_LAYER_TEMPLATE_URL='{}templates/elastic-beanstalk.cfn.yml'.format(TEMPLATE_URL_PREFX)
+FARGATE_LAYER_TEMPLATE_URL='{}templates/fargate.cfn.yml'.format(TEMPLATE_URL_PREFX)
 
-def get_regions(client):
-    """ Load the region codes
-    """
-    response = client.describe_regions()
-    regions = []
-    for region in response['Regions']:
-        regions.append(region['RegionName'])
-    return regions
+FOUNDATION_STACK_NAME='test-foundation-0'
+
+# delete_objects and batch_delete_image request limits
+S3_DELETE_BATCH=1000
+ECR_DELETE_BATCH=100
+
+TEARDOWN_WORKERS=8
 
-def get_availability_zones(client, region):
+# Times --reap tries to start deleting a stack before moving on without it
+REAP_ATTEMPTS=3
+
+KEY_PAIR_PREFIX='sktemplates-test-'
+
+STACK_DURATIONS_FILE='stack-durations.json'
+METRICS_FILE='api-calls.jsonl'
+JOURNAL_FILE='test-run.journal'
+
+# Default per-region limits, the service quotas and what already exists in the region are applied on top
+REGION_LIMITS = { 'stacks': 200, 'vpcs': 5, 'eips': 5, 'nat_gateways': 5 }
+QUOTA_CODES = {
+    'stacks': ('cloudformation', 'L-0485CB21'),
+    'vpcs': ('vpc', 'L-F678F1CE'),
+    'eips': ('ec2', 'L-0263D0A3'),
+    # NAT gateways per availability zone, every entry puts its single NAT gateway in the first
+    # of the region's two AZs so this caps the region's entries. Existing gateways are counted
+    # in every AZ, which can only hold back more entries than needed.
+    'nat_gateways': ('vpc', 'L-FE5A380F'),
+}
+
+# Stack name and options for each matrix entry
+STACK_OPTIONS = {
+    'vpc': { 'name': 'test-vpc-0' },
+    'vpc-bastion': { 'name': 'test-vpc-bastion-0' },
+    'vpc-bastion-eb-database': { 'name': 'test-eb-0', 'db_engine': 'mysql', 'db_alarm': False, 'enhanced_alarms': False },
+    'vpc-bastion-eb-database-alarm': { 'name': 'test-eb-alarm-0', 'db_engine': 'postgres', 'db_alarm': True, 'enhanced_alarms': False },
+    'vpc-bastion-eb-database-enhanced-alarm': { 'name': 'test-eb-enhanced-alarm-0', 'db_engine': 'mysql', 'db_alarm': True, 'enhanced_alarms': True },
+    'vpc-bastion-fargate': { 'name': 'test-vpc-bastion-fargate-0', 'lb_alarm': False },
+    'vpc-bastion-fargate-LB-alarm': { 'name': 'test-vpc-bastion-fargate-LBalarm-0', 'lb_alarm': True },
+    'vpc-bastion-fargate-database': { 'name': 'test-vpc-bastion-fargate-db-0', 'lb_alarm': False, 'db_engine': 'mysql', 'db_alarm': False, 'enhanced_alarms': False },
+    'vpc-bastion-fargate-database-alarm': { 'name': 'test-vpc-bastion-fargate-dbalarm-0', 'lb_alarm': False, 'db_engine': 'postgres', 'db_alarm': True, 'enhanced_alarms': False },
+    'vpc-bastion-fargate-database-enhanced-alarm': { 'name': 'test-vpc-bastion-fargate-db-enhanced-0', 'lb_alarm': False, 'db_engine': 'mysql', 'db_alarm': True, 'enhanced_alarms': True },
+    'vpc-bastion-fargate-database-LBalarm': { 'name': 'test-vpc-bastion-fargate-db-LBalarm-0', 'lb_alarm': True, 'db_engine': 'mysql', 'db_alarm': False, 'enhanced_alarms': False },
+    'vpc-bastion-fargate-database-alarm-LBalarm': { 'name': 'test-vpc-bastion-fargate-dbalarm-LBalarm-0', 'lb_alarm': True, 'db_engine': 'postgres', 'db_alarm': True, 'enhanced_alarms': False },
+    'vpc-bastion-fargate-database-enhanced-alarm-LBalarm': { 'name': 'test-vpc-bastion-fargate-db-enhanced-LBalarm-0', 'lb_alarm': True, 'db_engine': 'mysql', 'db_alarm': True, 'enhanced_alarms': True },
+}
+
+# Resources held by the nested vpc and bastion stacks every matrix entry builds, entries
+# are dev environments so the vpc has a single NAT gateway and its EIP
+VPC_COST = { 'stacks': 2, 'vpcs': 1, 'eips': 1, 'nat_gateways': 1 }
+BASTION_COST = { 'stacks': 1, 'vpcs': 0, 'eips': 1, 'nat_gateways': 0 }
+
+def get_availability_zones(context, region):
     """ Load the first two AZs for a region
     """
-    azs = client.describe_availability_zones()['AvailabilityZones']
+    azs = context.availability_zones(region)
 
     if len(azs) < 2:
         print 'Region without two AZs (skipping): {}'.format(region)
         return None
 
-    return [ azs[0]['ZoneName'], azs[1]['ZoneName'] ]
+    return azs[:2]
 
 def create_key_pair(client, name):
     """ Create a new key pair and return the private key
@@ -84,34 +139,100 @@ def create_bucket(client, name, region):
     else:
         client.create_bucket(Bucket=name, ACL='public-read', CreateBucketConfiguration={ 'LocationConstraint': region })
 
-def fargate_cleanup(session, config, stack_id, region):
-    """ Empty codepipeline bucket and ecr repository before fargate stack deletion 
+def delete_object_batch(client, bucket, objects):
+    """ Delete up to 1000 object versions with one request
+    """
+    response = client.delete_objects(Bucket=bucket, Delete={ 'Objects': objects, 'Quiet': True })
+    errors = response.get('Errors', [])
+    if errors:
+        raise RuntimeError('Failed to delete {} objects from {}: {}'.format(len(errors), bucket, errors[0]['Message']))
+
+def empty_bucket(client, bucket):
+    """ Delete every object version and delete marker in the bucket and return how many were removed
+    """
+    batch = []
+    deleted = 0
+    for page in client.get_paginator('list_object_versions').paginate(Bucket=bucket):
+        for item in page.get('Versions', []) + page.get('DeleteMarkers', []):
+            batch.append({ 'Key': item['Key'], 'VersionId': item['VersionId'] })
+            if len(batch) == S3_DELETE_BATCH:
+                delete_object_batch(client, bucket, batch)
+                deleted += len(batch)
+                batch = []
+    if batch:
+        delete_object_batch(client, bucket, batch)
+        deleted += len(batch)
+    return deleted
+
+def empty_repository(client, repository):
+    """ Delete every image in the ECR repository and return how many were removed
+    """
+    image_ids = []
+    for page in client.get_paginator('list_images').paginate(repositoryName=repository):
+        image_ids.extend(page['imageIds'])
+
+    for start in range(0, len(image_ids), ECR_DELETE_BATCH):
+        response = client.batch_delete_image(repositoryName=repository, imageIds=image_ids[start:start + ECR_DELETE_BATCH])
+        failures = [ failure for failure in response.get('failures', []) if failure['failureCode'] != 'ImageNotFound' ]
+        if failures:
+            raise RuntimeError('Failed to delete {} images from {}: {}'.format(len(failures), repository, failures[0]['failureReason']))
+    return len(image_ids)
+
+def fargate_cleanup(cfn_client, s3_client, ecr_client, stack_id):
+    """ Empty codepipeline bucket and ecr repository before fargate stack deletion
     """
 
-    # Get fargate stack information
-    cfn_client =  session.client('cloudformation', region_name=region, config=config)
-    cfn_stack = cfn_client.describe_stacks(StackName=stack_id)['Stacks'][0]
-    fargate_stack = None
-    for output in cfn_stack['Outputs']:
-        if output['OutputKey'] == 'FargateStackName':
-            fargate_stack = output
+    # A wrapper stack points at its nested fargate stack, a shared foundation entry is the fargate stack
+    fargate_stack = get_output(cfn_client, stack_id, 'FargateStackName') or stack_id
 
     # Get s3 bucket and ecr repository name.
-    s3_bucket_name = cfn_client.describe_stack_resource(StackName=fargate_stack['OutputValue'],LogicalResourceId='CodePipelineArtifactBucket')['StackResourceDetail']['PhysicalResourceId']
-    ecr_repository = cfn_client.describe_stack_resource(StackName=fargate_stack['OutputValue'],LogicalResourceId='EcrDockerRepository')['StackResourceDetail']['PhysicalResourceId']
-    
-    # Delete all objects in s3 bucket.
-    s3_client = session.client('s3', region_name=region, config=config)
-    all_objs = s3_client.list_objects_v2(Bucket=s3_bucket_name)
-    for obj in all_objs['Contents']:
-        s3_client.delete_object(Bucket=s3_bucket_name, Key=obj['Key'])
-
-    # Empty ecr repository
-    ecr_client = session.client('ecr', region_name=region, config=config)
-    ecr_images = ecr_client.list_images(repositoryName=ecr_repository)['imageIds']
-    
-    if(len(ecr_images) > 0):
-        ecr_client.batch_delete_image(repositoryName=ecr_repository, imageIds=ecr_images)
+    s3_bucket_name = cfn_client.describe_stack_resource(StackName=fargate_stack,LogicalResourceId='CodePipelineArtifactBucket')['StackResourceDetail']['PhysicalResourceId']
+    ecr_repository = cfn_client.describe_stack_resource(StackName=fargate_stack,LogicalResourceId='EcrDockerRepository')['StackResourceDetail']['PhysicalResourceId']
+
+    objects = empty_bucket(s3_client, s3_bucket_name)
+    images = empty_repository(ecr_client, ecr_repository)
+    print 'Emptied {} objects from {} and {} images from {}'.format(objects, s3_bucket_name, images, ecr_repository)
+
+def save_timeline(cfn_client, region, stack_id, path):
+    """ Save the create timeline of a stack and print its critical path, a failure only loses the timeline
+    """
+    try:
+        profile = timeline.profile_stack(cfn_client, stack_id, region)
+    except botocore.exceptions.ClientError as ce:
+        print 'Failed to profile stack: {} - region: {} - error: {}'.format(stack_id, region, ce)
+        return
+    timeline.save_profile(path, profile)
+    print 'Critical path of {} in {}: {}'.format(profile['stack_name'], region, ' > '.join(name for name, _ in timeline.critical_path(profile)))
+
+def teardown_stack(cfn_client, s3_client, ecr_client, stack_id, fargate, region=None, timeline_path=None):
+    """ Empty what the stack cannot delete itself, then start deleting the stack
+
+    Runs on the teardown pool so large artifact buckets do not hold up other stacks.
+    With timeline_path set, the stack's create timeline is saved there first.
+    """
+    if timeline_path:
+        save_timeline(cfn_client, region, stack_id, timeline_path)
+    if fargate:
+        fargate_cleanup(cfn_client, s3_client, ecr_client, stack_id)
+    cfn_client.delete_stack(StackName=stack_id)
+
+def remove_app_buckets(context, buckets):
+    """ Empty and delete the sample app buckets ensure_foundation journaled, given as {region: bucket}
+    """
+    def remove(job):
+        client, name = job
+        if has_bucket(client, name):
+            empty_bucket(client, name)
+            client.delete_bucket(Bucket=name)
+            print 'Deleted bucket: {}'.format(name)
+
+    jobs = [ (context.client('s3', region), name) for region, name in sorted(buckets.items()) ]
+    pool = ThreadPool(TEARDOWN_WORKERS)
+    try:
+        pool.map(remove, jobs)
+    finally:
+        pool.close()
+        pool.join()
 
 def update_sample_app(client, app_bucket_name, source_bucket_name, app_key):
     """ Copy a sample app from the central bucket to the region where the stack is being created
@@ -121,35 +242,6 @@ def update_sample_app(client, app_bucket_name, source_bucket_name, app_key):
     client.copy(copy_source, app_bucket_name, app_key)
     client.put_object_acl(ACL='public-read', Bucket=app_bucket_name, Key=app_key)
 
-def is_stack(client, stack_id, state):
-    """ Returns true if the stack is in the passed state
-    """
-    for stack in client.describe_stacks(StackName=stack_id)['Stacks']:
-        if stack['StackStatus'] == state:
-            return True
-    return False
-
-def has_stack_create_error(client, stack_id):
-    """ Returns true if the stack status is anything but CREATE_COMPLETE
-    """
-    for stack in client.describe_stacks(StackName=stack_id)['Stacks']:
-        if stack['StackStatus'] == 'CREATE_COMPLETE':
-            return False
-    return True
-
-def has_stack_delete_error(client, stack_id):
-    """ Returns true if the stack fails to delete
-    """
-    try:
-        for stack in client.describe_stacks(StackName=stack_id)['Stacks']:
-            if stack['StackStatus'] != 'DELETE_COMPLETE':
-                return True
-        return False
-    except botocore.exceptions.ClientError as ce:
-        if ce.response['Error']['Code'] == 'ValidationError':
-            return False
-        raise ce
-
 def create_stack(client, stack_name, template_url, parameters):
     response = client.create_stack(
         StackName=stack_name,
@@ -219,7 +311,7 @@ def create_vpc_fargate(client, stack_name, azs, environment, ssh_key, github, al
         { 'ParameterKey': 'TemplateBucket', 'ParameterValue': TEMPLATE_BUCKET},
         { 'ParameterKey': 'GitHubUser', 'ParameterValue': github['user']},
         { 'ParameterKey': 'GitHubToken', 'ParameterValue': github['token']},
-        { 'ParameterKey': 'GitHubSourceRepo', 'ParameterValue': github['repo']},
+        { 'ParameterKey': 'GitSourceRepo', 'ParameterValue': github['repo']},
     ]
 
     if alarms:
@@ -238,7 +330,7 @@ def create_vpc_fargate_db(client, stack_name, azs, environment, ssh_key, github,
         { 'ParameterKey': 'TemplateBucket', 'ParameterValue': TEMPLATE_BUCKET},
         { 'ParameterKey': 'GitHubUser', 'ParameterValue': github['user']},
         { 'ParameterKey': 'GitHubToken', 'ParameterValue': github['token']},
-        { 'ParameterKey': 'GitHubSourceRepo', 'ParameterValue': github['repo']},
+        { 'ParameterKey': 'GitSourceRepo', 'ParameterValue': github['repo']},
         { 'ParameterKey': 'DatabasePassword', 'ParameterValue': 'startupadmin6' },
         { 'ParameterKey': 'DatabaseEngine', 'ParameterValue': db_engine },
     ]
@@ -254,187 +346,718 @@ def create_vpc_fargate_db(client, stack_name, azs, environment, ssh_key, github,
 
     return create_stack(client, stack_name, FARGATE_RDS_TEMPLATE_URL, parameters)
 
-def wait_for_stacks(stacks, create):
-
-    action = 'create' if create else 'delete'
-    print 'Waiting for stacks to {}'.format(action)
-
-    while True:
-        all_done = True
-        for stack in stacks:
-            for stack_id in stack['stack_ids']:
-                if create:
-                    if not is_stack(stack['client'], stack_id, 'CREATE_IN_PROGRESS'):
-                        if has_stack_create_error(stack['client'], stack_id):
-                            print 'Stack failed to create stack id: {} - region: {}'.format(stack_id, stack['region'])
-                    else:
-                        all_done = False
-                else:
-                    if not is_stack(stack['client'], stack_id, 'DELETE_IN_PROGRESS'):
-                        if has_stack_delete_error(stack['client'], stack_id):
-                            print 'Stack failed to delete stack id: {} - region: {}'.format(stack_id, stack['region'])
-                    else:
-                        all_done = False
-
-        if all_done:
-            return
-        time.sleep(5)
-
-def ensure_foundation(session, config):
+def ensure_foundation(context, journal=None):
     """ Make sure we have everything we need in place to run the stacks
     """
     key_pairs={}
-    for region in get_regions(session.client('ec2', region_name='us-east-1', config=config)):
+    for region in context.regions():
 
         print 'Ensure key pair in region: {}'.format(region)
 
-        ec2_client = session.client('ec2', region_name=region, config=config)
+        ec2_client = context.client('ec2', region)
         key_name = '{}{}'.format(KEY_PAIR_PREFIX, region)
+        # A key pair left by an earlier run is reused, its material is gone but nothing needs it
+        key_pairs[region] = {"KeyName":key_name, "KeyMaterial": None}
         if not has_key_pair(ec2_client, key_name):
-            key_material = create_key_pair(ec2_client, key_name)
-            key_pairs[region] = {"KeyName":key_name, "KeyMaterial": key_material}
+            key_pairs[region]["KeyMaterial"] = create_key_pair(ec2_client, key_name)
+        if journal:
+            journal.record('key_pair', region=region, key_name=key_name)
 
-        s3_client = session.client('s3', region_name=region, config=config)
+        s3_client = context.client('s3', region)
 
         print 'Ensure S3 app bucket in region: {}'.format(region)
 
         app_bucket_name = '{}{}'.format(TEST_APP_BUCKET_PREFIX, region)
         if not has_bucket(s3_client, app_bucket_name):
             create_bucket(s3_client, app_bucket_name, region)
+        if journal:
+            journal.record('bucket', region=region, bucket=app_bucket_name)
 
         # Copy the latest version of the file to the bucket
         update_sample_app(s3_client, app_bucket_name, TEST_APP_SOURCE_BUCKET, TEST_PYTHON_APP_KEY)
 
     return key_pairs    
 
-def remove_keypairs(session, config, key_pairs):
+def remove_keypairs(context, key_pairs):
     """ Remove key-pairs created as part of test harness
     """
 
-    for region in get_regions(session.client('ec2', region_name='us-east-1', config=config)):
+    for region in sorted(key_pairs):
 
-        ec2_client = session.client('ec2', region_name=region, config=config)
+        ec2_client = context.client('ec2', region)
         delete_key_pair(ec2_client, key_pairs[region]['KeyName'])
         print 'Deleted keypair: {} in region: {}'.format(key_pairs[region]['KeyName'],region)
 
-def test_stack(session, config, stack_type, github, key_pairs):
-    """ Create a specific stack in supported regions, wait for it to create and then delete it
+def is_fargate(stack_type):
+    return stack_type.startswith('vpc-bastion-fargate')
+
+def runs_in_region(stack_type, region):
+    """ Fargate stacks are only tested in us-east-1
     """
-    stacks = []
-    fargate = {}
-    
-    for region in get_regions(session.client('ec2', region_name='us-east-1', config=config)):
+    return not is_fargate(stack_type) or region == 'us-east-1'
 
-        azs = get_availability_zones(session.client('ec2', region_name=region, config=config), region)
+def stack_cost(stack_type, shared=False):
+    """ Region resources a stack type holds while it exists
+    """
+    options = STACK_OPTIONS[stack_type]
+    cost = { 'stacks': 0, 'vpcs': 0, 'eips': 0, 'nat_gateways': 0 }
+    if not shared or stack_type == 'vpc':
+        # The root stack plus its nested vpc and bastion stacks
+        cost = dict(VPC_COST)
+        if stack_type != 'vpc':
+            for key, value in BASTION_COST.items():
+                cost[key] += value
+    if stack_type.startswith('vpc-bastion-eb') or is_fargate(stack_type):
+        cost['stacks'] += 1
+    if 'db_engine' in options:
+        cost['stacks'] += 1
+    return cost
+
+def create_test_stack(cfn_client, stack_type, region, azs, key_name, app_bucket_name, github):
+    """ Create the full stack for one matrix entry in one region and return the stack id
+    """
+    options = STACK_OPTIONS[stack_type]
 
-        fargate[region] = False
-        # Single AZ regions are not supported e.g., ap-northeast-3
-        if azs is None:
-            continue
+    if stack_type == 'vpc':
+        return create_vpc_stack(cfn_client, options['name'], azs, 'dev')
 
-        stack = {}
-        stacks.append(stack)
-        cfn_client =  session.client('cloudformation', region_name=region, config=config)
-        stack['client'] = cfn_client
-        stack['region'] = region
+    if stack_type == 'vpc-bastion':
+        return create_vpc_bastion_stack(cfn_client, options['name'], azs, 'dev', key_name)
 
-        stack_ids = []
-        stack['stack_ids'] = stack_ids
+    if stack_type.startswith('vpc-bastion-eb'):
+        return create_eb_stack(cfn_client, options['name'], azs, 'dev', key_name, app_bucket_name, TEST_PYTHON_APP_KEY, 'python', options['db_engine'], options['db_alarm'], options['enhanced_alarms'])
 
-        key_name = key_pairs[region]['KeyName']
-        app_bucket_name = '{}{}'.format(TEST_APP_BUCKET_PREFIX, region)
+    if 'db_engine' in options:
+        return create_vpc_fargate_db(cfn_client, options['name'], azs, 'dev', key_name, github, options['lb_alarm'], options['db_engine'], options['db_alarm'], options['enhanced_alarms'])
+
+    return create_vpc_fargate(cfn_client, options['name'], azs, 'dev', key_name, github, options['lb_alarm'])
+
+def database_layer(stack_name, network_stack_name, db_engine, alarms, enhanced_alarms):
+    """ The db or aurora template on its own, as the vpc-bastion-* wrappers would nest it
+    """
+    parameters = [
+        { 'ParameterKey': 'NetworkStackName', 'ParameterValue': network_stack_name },
+        { 'ParameterKey': 'EnvironmentName', 'ParameterValue': 'dev' },
+        { 'ParameterKey': 'DatabasePassword', 'ParameterValue': 'startupadmin6' },
+        { 'ParameterKey': 'DatabaseEngine', 'ParameterValue': db_engine },
+    ]
+
+    if alarms:
+        parameters.append({ 'ParameterKey': 'EnableAlarms', 'ParameterValue': 'true' })
+        if enhanced_alarms:
+            parameters.append({ 'ParameterKey': 'DatabaseAlarmEvaluationPeriodSeconds', 'ParameterValue': '60' })
+            parameters.append({ 'ParameterKey': 'EnhancedMonitoring', 'ParameterValue': 'true' })
+
+    template_url = AURORA_TEMPLATE_URL if db_engine.startswith('aurora') else DB_TEMPLATE_URL
+    return { 'name': stack_name, 'template_url': template_url, 'parameters': parameters }
 
-        if stack_type == 'vpc':
-            print 'Creating vpc stack in: {}'.format(region)
-            stack_ids.append(create_vpc_stack(cfn_client, 'test-vpc-0', azs, 'dev'))
-
-        if stack_type == 'vpc-bastion':
-            print 'Creating vpc bastion stack in: {}'.format(region)
-            stack_ids.append(create_vpc_bastion_stack(cfn_client, 'test-vpc-bastion-0', azs, 'dev', key_name))
-
-        if stack_type == 'vpc-bastion-eb-database':
-            print 'Creating eb stack in: {}'.format(region)
-            stack_ids.append(create_eb_stack(cfn_client, 'test-eb-0', azs, 'dev', key_name, app_bucket_name, TEST_PYTHON_APP_KEY, 'python', 'mysql', False, False))
-
-        if stack_type == 'vpc-bastion-eb-database-alarm':
-            print 'Creating eb stack in: {}'.format(region)
-            stack_ids.append(create_eb_stack(cfn_client, 'test-eb-alarm-0', azs, 'dev', key_name, app_bucket_name, TEST_PYTHON_APP_KEY, 'python', 'postgres', True, False))
-
-        if stack_type == 'vpc-bastion-eb-database-enhanced-alarm':
-            print 'Creating eb stack with enhanced db monitoring in: {}'.format(region)
-            stack_ids.append(create_eb_stack(cfn_client, 'test-eb-enhanced-alarm-0', azs, 'dev', key_name, app_bucket_name, TEST_PYTHON_APP_KEY, 'python', 'mysql', True, True))
-
-        if stack_type == 'vpc-bastion-fargate' and region == 'us-east-1':
-            fargate['us-east-1'] = True
-            print 'Creating fargate stack in {}'.format(region)
-            stack_ids.append(create_vpc_fargate(cfn_client,'test-vpc-bastion-fargate-0', azs, 'dev', key_name, github, False))
-
-        if stack_type == 'vpc-bastion-fargate-LB-alarm' and region == 'us-east-1':
-            fargate['us-east-1'] = True
-            print 'Creating fargate stack with LB Alarm enabled in {}'.format(region)
-            stack_ids.append(create_vpc_fargate(cfn_client,'test-vpc-bastion-fargate-LBalarm-0', azs, 'dev', key_name, github, True))
-
-        if stack_type == 'vpc-bastion-fargate-database' and region == 'us-east-1':
-            fargate['us-east-1'] = True
-            print 'Creating fargate with DB stack in {}'.format(region)
-            stack_ids.append(create_vpc_fargate_db(cfn_client,'test-vpc-bastion-fargate-db-0', azs, 'dev', key_name, github, False, 'mysql', False, False))
-                                                    
-        if stack_type == 'vpc-bastion-fargate-database-alarm' and region == 'us-east-1':
-            fargate['us-east-1'] = True
-            print 'Creating fargate stack with DB and DB alarm in {}'.format(region)
-            stack_ids.append(create_vpc_fargate_db(cfn_client,'test-vpc-bastion-fargate-dbalarm-0', azs, 'dev', key_name, github, False, 'postgres', True, False))
-
-        if stack_type == 'vpc-bastion-fargate-database-enhanced-alarm' and region == 'us-east-1':
-            fargate['us-east-1'] = True
-            print 'Creating fargate stack with enhanced db monitoring in {}'.format(region)
-            stack_ids.append(create_vpc_fargate_db(cfn_client,'test-vpc-bastion-fargate-db-enhanced-0', azs, 'dev', key_name, github, False, 'mysql', True, True))
-
-        if stack_type == 'vpc-bastion-fargate-database-LBalarm' and region == 'us-east-1':
-            fargate['us-east-1'] = True
-            print 'Creating fargate stack with database and LB alarm enabled in {}'.format(region)
-            stack_ids.append(create_vpc_fargate_db(cfn_client,'test-vpc-bastion-fargate-db-LBalarm-0', azs, 'dev', key_name, github, True, 'mysql', False, False))
-
-        if stack_type == 'vpc-bastion-fargate-database-alarm-LBalarm' and region == 'us-east-1':
-            fargate['us-east-1'] = True
-            print 'Creating fargate stack with db alarm and LB alarm in {}'.format(region)
-            stack_ids.append(create_vpc_fargate_db(cfn_client,'test-vpc-bastion-fargate-dbalarm-LBalarm-0', azs, 'dev', key_name, github, True, 'postgres', True, False))
-
-        if stack_type == 'vpc-bastion-fargate-database-enhanced-alarm-LBalarm' and region == 'us-east-1':
-            fargate['us-east-1'] = True
-            print 'Creating fargate stack with LB alarm and enhanced db monitoring in {}'.format(region)
-            stack_ids.append(create_vpc_fargate_db(cfn_client,'test-vpc-bastion-fargate-db-enhanced-LBalarm-0', azs, 'dev', key_name, github, True, 'mysql', True, True))
-
-    time.sleep(5)
-
-    # Wait for the stacks to create
-    wait_for_stacks(stacks, True)
-
-    print 'Deleting stacks'
+def eb_layer(stack_name, network_stack_name, db_stack_name, ssh_key, app_bucket, app_key, stack_type):
+    parameters = [
+        { 'ParameterKey': 'ApplicationName', 'ParameterValue': stack_name },
+        { 'ParameterKey': 'StackType', 'ParameterValue': stack_type },
+        { 'ParameterKey': 'EnvironmentName', 'ParameterValue': 'dev' },
+        { 'ParameterKey': 'NetworkStackName', 'ParameterValue': network_stack_name },
+        { 'ParameterKey': 'DatabaseStackName', 'ParameterValue': db_stack_name },
+        { 'ParameterKey': 'DatabaseName', 'ParameterValue': 'StartupDB' },
+        { 'ParameterKey': 'DatabasePassword', 'ParameterValue': 'startupadmin6' },
+        { 'ParameterKey': 'AppS3Bucket', 'ParameterValue': app_bucket },
+        { 'ParameterKey': 'AppS3Key', 'ParameterValue': app_key },
+        { 'ParameterKey': 'EC2KeyPairName', 'ParameterValue': ssh_key },
+        { 'ParameterKey': 'DevInstanceType', 'ParameterValue': 't2.small' },
+    ]
+    return { 'name': stack_name, 'template_url': EB_LAYER_TEMPLATE_URL, 'parameters': parameters }
+
+def fargate_layer(stack_name, network_stack_name, db_stack_name, github, lb_alarm):
+    parameters = [
+        { 'ParameterKey': 'NetworkStackName', 'ParameterValue': network_stack_name },
+        { 'ParameterKey': 'DatabaseStackName', 'ParameterValue': db_stack_name },
+        { 'ParameterKey': 'EnvironmentName', 'ParameterValue': 'dev' },
+        { 'ParameterKey': 'GitHubUser', 'ParameterValue': github['user']},
+        { 'ParameterKey': 'GitHubToken', 'ParameterValue': github['token']},
+        { 'ParameterKey': 'GitSourceRepo', 'ParameterValue': github['repo']},
+    ]
+
+    if lb_alarm:
+        parameters.append({ 'ParameterKey': 'EnableLBAlarm', 'ParameterValue': 'true' })
+
+    return { 'name': stack_name, 'template_url': FARGATE_LAYER_TEMPLATE_URL, 'parameters': parameters }
+
+def shared_layers(stack_type, network_stack_name, key_name, app_bucket_name, github):
+    """ The stacks a matrix entry needs on top of a shared vpc and bastion, in creation order
+    """
+    options = STACK_OPTIONS[stack_type]
+    layers = []
+    db_stack_name = ''
+
+    if 'db_engine' in options:
+        db_stack_name = '{}-db'.format(options['name'])
+        layers.append(database_layer(db_stack_name, network_stack_name, options['db_engine'], options['db_alarm'], options['enhanced_alarms']))
+
+    if stack_type.startswith('vpc-bastion-eb'):
+        layers.append(eb_layer(options['name'], network_stack_name, db_stack_name, key_name, app_bucket_name, TEST_PYTHON_APP_KEY, 'python'))
+
+    if is_fargate(stack_type):
+        layers.append(fargate_layer(options['name'], network_stack_name, db_stack_name, github, options['lb_alarm']))
+
+    return layers
+
+class RecordingClient(object):
+    """ Stands in for a CloudFormation client and keeps what create_stack would have sent
+    """
+
+    def __init__(self):
+        self.requests = []
+
+    def create_stack(self, StackName, TemplateURL, Parameters, **kwargs):
+        self.requests.append((TemplateURL, Parameters))
+        return { 'StackId': StackName }
+
+def preflight(index, requests):
+    """ Check (template url, parameters) pairs against the templates in this repository and return the problems
+    """
+    errors = []
+    for template_url, parameters in requests:
+        errors.extend(index.check_parameters(template_url[len(TEMPLATE_URL_PREFX):], validate.parameter_values(parameters)))
+    return errors
+
+def preflight_combination(index, combination, azs, key_pairs, github):
+    """ The problems the templates would reject a matrix entry for, before anything is created
+    """
+    region = combination['region']
+    if 'layers' in combination:
+        requests = [ (layer['template_url'], layer['parameters']) for layer in combination['layers'] ]
+    else:
+        client = RecordingClient()
+        create_test_stack(client, combination['stack_type'], region, azs[region],
+            key_pairs[region]['KeyName'], '{}{}'.format(TEST_APP_BUCKET_PREFIX, region), github)
+        requests = client.requests
+    errors = preflight(index, requests)
+    if combination['stack_type'] != 'vpc':
+        errors.extend(index.check_regions([ region ]))
+    return errors
+
+def preflight_foundation(index, region, azs, key_pairs):
+    """ The problems the templates would reject a region's shared foundation for
+    """
+    client = RecordingClient()
+    create_vpc_bastion_stack(client, FOUNDATION_STACK_NAME, azs[region], 'dev', key_pairs[region]['KeyName'])
+    return preflight(index, client.requests) + index.check_regions([ region ])
+
+def create_layer(cfn_client, region, layer):
+    print 'Creating {} stack in: {}'.format(layer['name'], region)
+    return create_stack(cfn_client, layer['name'], layer['template_url'], layer['parameters'])
+
+def get_output(client, stack_id, key):
+    for output in client.describe_stacks(StackName=stack_id)['Stacks'][0].get('Outputs', []):
+        if output['OutputKey'] == key:
+            return output['OutputValue']
+    return None
+
+def get_quota(client, service_code, quota_code, default):
+    """ Read a service quota, falling back to the default when it cannot be read
+    """
+    try:
+        return int(client.get_service_quota(ServiceCode=service_code, QuotaCode=quota_code)['Quota']['Value'])
+    except (botocore.exceptions.ClientError, botocore.exceptions.BotoCoreError):
+        return default
+
+def region_headroom(context, region):
+    """ What is left of the region limits once the resources that already exist are counted
+    """
+    ec2_client = context.client('ec2', region)
+    quotas_client = context.client('service-quotas', region)
+
+    limits = dict(REGION_LIMITS)
+    for key, (service_code, quota_code) in QUOTA_CODES.items():
+        limits[key] = get_quota(quotas_client, service_code, quota_code, limits[key])
+
+    limits['vpcs'] -= len(ec2_client.describe_vpcs()['Vpcs'])
+    limits['eips'] -= len(ec2_client.describe_addresses()['Addresses'])
+    limits['nat_gateways'] -= len(ec2_client.describe_nat_gateways(
+        Filters=[ { 'Name': 'state', 'Values': [ 'pending', 'available' ] } ])['NatGateways'])
+    return limits
+
+class RegionBudget(object):
+    """ Tracks the resources held by running stacks against each region's headroom
+    """
+
+    def __init__(self, headroom):
+        self.headroom = headroom
+        self.used = dict((region, dict((key, 0) for key in limits)) for region, limits in headroom.items())
+
+    def fits(self, region, cost):
+        return all(self.used[region][key] + value <= self.headroom[region][key] for key, value in cost.items())
+
+    def ever_fits(self, region, cost):
+        return all(value <= self.headroom[region][key] for key, value in cost.items())
+
+    def take(self, region, cost):
+        for key, value in cost.items():
+            self.used[region][key] += value
+
+    def give(self, region, cost):
+        for key, value in cost.items():
+            self.used[region][key] -= value
+
+def create_foundations(context, watcher, azs, key_pairs, budget, regions, journal, existing):
+    """ Build one vpc and bastion stack per region
+
+    existing maps a region to a foundation stack an interrupted run left, it is waited on
+    instead of creating another. Returns the network stack name of each region whose
+    foundation was created, the foundation stacks, and the create status of each foundation.
+    """
+    stacks = []
+    cost = stack_cost('vpc-bastion')
+    for region in regions:
+        if region not in existing and not budget.fits(region, cost):
+            print 'Skipping shared foundation in {}: needs {} but the region only has {}'.format(region, cost, budget.headroom[region])
+            continue
+        cfn_client = context.client('cloudformation', region)
+        if region in existing:
+            stack_id = existing[region]
+            print 'Resuming shared foundation stack: {} - region: {}'.format(stack_id, region)
+        else:
+            print 'Creating shared foundation stack in: {}'.format(region)
+            stack_id = create_vpc_bastion_stack(cfn_client, FOUNDATION_STACK_NAME, azs[region], 'dev', key_pairs[region]['KeyName'])
+            journal.stack(stack_id, 'vpc-bastion', region, 'creating', foundation=True)
+        budget.take(region, cost)
+        stacks.append({ 'client': cfn_client, 'region': region, 'stack_ids': [ stack_id ] })
+
+    foundations = {}
+    statuses = {}
+    for event in watcher.watch(stacks, 'create'):
+        statuses[event['region']] = event['status']
+        journal.stack(event['stack_id'], 'vpc-bastion', event['region'], 'created', event['status'], event['ok'], foundation=True)
+        if not event['ok']:
+            print 'Shared foundation failed to create stack id: {} - region: {} - status: {}'.format(event['stack_id'], event['region'], event['status'])
+        else:
+            foundations[event['region']] = get_output(context.client('cloudformation', event['region']), event['stack_id'], 'VpcStackName')
+    return foundations, stacks, statuses
+
+def delete_foundations(watcher, stacks, journal):
+    """ Delete the shared foundations once nothing is deployed on them and return each region's delete status
+    """
     for stack in stacks:
         for stack_id in stack['stack_ids']:
-            if fargate[stack['region']]:
-                fargate_cleanup(session, config, stack_id, stack['region'])
-            print 'Deleting stack: {} - region: {}'.format(stack_id, stack['region'])    
+            print 'Deleting shared foundation stack: {} - region: {}'.format(stack_id, stack['region'])
             stack['client'].delete_stack(StackName=stack_id)
+            journal.stack(stack_id, 'vpc-bastion', stack['region'], 'deleting', foundation=True)
+
+    statuses = {}
+    for event in watcher.watch(stacks, 'delete'):
+        statuses[event['region']] = event['status']
+        journal.stack(event['stack_id'], 'vpc-bastion', event['region'], 'deleted', event['status'], event['ok'], foundation=True)
+        if not event['ok']:
+            print 'Shared foundation failed to delete stack id: {} - region: {} - status: {}'.format(event['stack_id'], event['region'], event['status'])
+    return statuses
+
+def restore_from_journal(journal, queue, results):
+    """ Take the entries an earlier run finished or left in flight out of the queue
+
+    Returns the entries that were in flight, each with the journal state of its stacks, oldest first.
+    """
+    for key, result in journal.results().items():
+        if key in results:
+            results[key].update(result)
+    done = journal.done()
+    stacks = [ stack for stack in journal.stacks() if not stack['foundation'] ]
+    in_flight = []
+    for combination in list(queue):
+        key = (combination['stack_type'], combination['region'])
+        entry_stacks = [ stack for stack in stacks if (stack['stack_type'], stack['region']) == key ]
+        if key in done:
+            queue.remove(combination)
+        elif entry_stacks:
+            queue.remove(combination)
+            combination['journal'] = entry_stacks
+            in_flight.append(combination)
+    return in_flight
+
+def run_matrix(context, watcher, tests, github, key_pairs, shared=False, timeline_dir=None, journal=None):
+    """ Create, wait for and delete every matrix entry in every supported region
+
+    Entries run at the same time as long as the region has room for the VPCs, EIPs,
+    NAT gateways and stacks they need. The rest wait until a running entry is deleted.
+
+    With shared set, one vpc and bastion stack is built per region first and each
+    entry only deploys the templates it adds on top of it, one stack per template.
+
+    With timeline_dir set, every stack's create timeline is saved there before it is deleted.
+
+    Progress is recorded in journal. Entries the journal shows as finished are skipped and
+    the stacks of entries it shows in flight are picked up where they were left.
+
+    A stack whose delete cannot be started is tried REAP_ATTEMPTS times. After that the
+    entry's remaining stacks, and its region's shared foundation, are left for --reap.
+    """
+    journal = journal or RunJournal()
+    regions = context.regions()
+    azs = {}
+    for region in regions:
+        # Single AZ regions are not supported e.g., ap-northeast-3
+        region_azs = get_availability_zones(context, region)
+        if region_azs is not None:
+            azs[region] = region_azs
+
+    queue = []
+    # A stack type names its stacks, so running one twice at once would collide
+    stack_types = sorted(set(tests), key=tests.index)
+    for stack_type in stack_types:
+        for region in regions:
+            if region in azs and runs_in_region(stack_type, region):
+                queue.append({ 'stack_type': stack_type, 'region': region, 'cost': stack_cost(stack_type, shared) })
+
+    index = validate.TemplateIndex()
+    results = dict(((combination['stack_type'], combination['region']), {}) for combination in queue)
+    in_flight = restore_from_journal(journal, queue, results)
+
+    def set_result(stack_type, region, action, status):
+        results[(stack_type, region)][action] = status
+        journal.record('result', stack_type=stack_type, region=region, action=action, status=status)
+
+    def refuse_invalid():
+        """ Drop the entries the templates would reject, printing each distinct problem once per stack type
+        """
+        reported = set()
+        for combination in list(queue):
+            errors = preflight_combination(index, combination, azs, key_pairs, github)
+            if not errors:
+                continue
+            queue.remove(combination)
+            set_result(combination['stack_type'], combination['region'], 'create', 'INVALID')
+            journal.record('entry_done', stack_type=combination['stack_type'], region=combination['region'])
+            for error in errors:
+                if (combination['stack_type'], error) not in reported:
+                    reported.add((combination['stack_type'], error))
+                    print 'Refusing {} in {}: {}'.format(combination['stack_type'], combination['region'], error)
+
+    # Shared entries are checked once their layers are known
+    if not shared:
+        refuse_invalid()
+    budget = RegionBudget(dict((region, region_headroom(context, region))
+        for region in set(combination['region'] for combination in queue + in_flight)))
+    running = {}
+
+    foundation_stacks = []
+    if shared:
+        existing = dict((stack['region'], stack['stack_id']) for stack in journal.stacks()
+            if stack['foundation'] and stack['phase'] in ('creating', 'created'))
+        foundation_regions = sorted(set(combination['region'] for combination in queue + in_flight if combination['stack_type'] != 'vpc') | set(existing))
+        # A foundation bound to be rejected is not deployed, the entries on top of it are refused with it
+        invalid = {}
+        for region in foundation_regions:
+            errors = [] if region in existing else preflight_foundation(index, region, azs, key_pairs)
+            for error in errors:
+                print 'Refusing shared foundation in {}: {}'.format(region, error)
+            if errors:
+                invalid[region] = 'INVALID'
+        foundation_regions = [ region for region in foundation_regions if region not in invalid ]
+        foundations, foundation_stacks, foundation_statuses = create_foundations(context, watcher, azs, key_pairs, budget, foundation_regions, journal, existing)
+        foundation_statuses.update(invalid)
+        for combination in list(queue) + in_flight:
+            region = combination['region']
+            stack_type = combination['stack_type']
+            if stack_type == 'vpc' or region not in foundations:
+                continue
+            combination['layers'] = shared_layers(stack_type, foundations[region],
+                key_pairs[region]['KeyName'], '{}{}'.format(TEST_APP_BUCKET_PREFIX, region), github)
+        for combination in list(queue):
+            region = combination['region']
+            stack_type = combination['stack_type']
+            if stack_type != 'vpc' and (stack_type == 'vpc-bastion' or region not in foundations):
+                # The foundation stands in for the vpc-bastion entry, its delete status is filled in at the end
+                queue.remove(combination)
+                set_result(stack_type, region, 'create', foundation_statuses.get(region, 'SKIPPED'))
+                journal.record('entry_done', stack_type=stack_type, region=region)
+        refuse_invalid()
+
+    def create_next(combination):
+        """ Create the combination's next stack, returns False when the create call itself fails
+        """
+        region = combination['region']
+        cfn_client = context.client('cloudformation', region)
+        try:
+            if 'layers' in combination:
+                stack_id = create_layer(cfn_client, region, combination['layers'][combination['created']])
+            else:
+                print 'Creating {} stack in: {}'.format(combination['stack_type'], region)
+                stack_id = create_test_stack(cfn_client, combination['stack_type'], region, azs[region],
+                    key_pairs[region]['KeyName'], '{}{}'.format(TEST_APP_BUCKET_PREFIX, region), github)
+        except botocore.exceptions.ClientError as ce:
+            print 'Stack failed to create type: {} - region: {} - error: {}'.format(combination['stack_type'], region, ce)
+            set_result(combination['stack_type'], region, 'create', 'CREATE_FAILED')
+            return False
+        journal.stack(stack_id, combination['stack_type'], region, 'creating')
+        combination['created'] += 1
+        combination['stack_ids'].append(stack_id)
+        running[stack_id] = combination
+        watcher.add(cfn_client, region, stack_id, 'create')
+        return True
+
+    def teardown(cfn_client, s3_client, ecr_client, stack_id, fargate, stack_type, region, timeline_path):
+        teardown_stack(cfn_client, s3_client, ecr_client, stack_id, fargate, region, timeline_path)
+        journal.stack(stack_id, stack_type, region, 'deleting')
+
+    def delete_next(combination):
+        """ Delete the combination's stacks newest first, returns False once none are left
+        """
+        region = combination['region']
+        if not combination['stack_ids']:
+            return False
+        stack_id = combination['stack_ids'].pop()
+        fargate = is_fargate(combination['stack_type']) and not combination['cleaned']
+        combination['cleaned'] = True
+        combination['emptying'] = fargate
+        combination['attempts'] = combination['attempts'] + 1 if combination.get('deleting') == stack_id else 1
+        combination['deleting'] = stack_id
+        print 'Deleting stack: {} - region: {}'.format(stack_id, region)
+        cfn_client = context.client('cloudformation', region)
+        # The clients are looked up here rather than in the pool, the teardown threads share them
+        timeline_path = os.path.join(timeline_dir, '{}.{}.json'.format(stack_name(stack_id), region)) if timeline_dir else None
+        started = teardown_pool.apply_async(teardown, (cfn_client, context.client('s3', region), context.client('ecr', region),
+            stack_id, fargate, combination['stack_type'], region, timeline_path))
+        running[stack_id] = combination
+        watcher.add(cfn_client, region, stack_id, 'delete', after=started)
+        return True
+
+    def finish(combination):
+        journal.record('entry_done', stack_type=combination['stack_type'], region=combination['region'])
+        budget.give(combination['region'], combination['cost'])
+        start_ready()
+
+    def start_ready():
+        for combination in list(queue):
+            region = combination['region']
+            if not budget.ever_fits(region, combination['cost']):
+                queue.remove(combination)
+                set_result(combination['stack_type'], region, 'create', 'SKIPPED')
+                journal.record('entry_done', stack_type=combination['stack_type'], region=region)
+                print 'Skipping {} in {}: needs {} but the region only has {}'.format(combination['stack_type'], region, combination['cost'], budget.headroom[region])
+                continue
+            if not budget.fits(region, combination['cost']):
+                continue
+
+            queue.remove(combination)
+            budget.take(region, combination['cost'])
+            combination['stack_ids'] = []
+            combination['created'] = 0
+            combination['cleaned'] = False
+            if not create_next(combination):
+                journal.record('entry_done', stack_type=combination['stack_type'], region=region)
+                budget.give(region, combination['cost'])
+
+    def resume(combination):
+        """ Pick an in flight entry up at the phase its newest stack was left in
+        """
+        region = combination['region']
+        stacks = combination.pop('journal')
+        combination['stack_ids'] = [ stack['stack_id'] for stack in stacks if stack['phase'] != 'deleted' ]
+        combination['created'] = len(stacks)
+        combination['cleaned'] = any(stack['phase'] in ('deleting', 'deleted') for stack in stacks)
+        budget.take(region, combination['cost'])
+        cfn_client = context.client('cloudformation', region)
+        newest = [ stack for stack in stacks if stack['phase'] != 'deleted' ]
+        phase = newest[-1]['phase'] if newest else None
+        print 'Resuming {} in {} at {}'.format(combination['stack_type'], region, phase or 'deleted')
+
+        if phase in ('creating', 'deleting'):
+            stack_id = newest[-1]['stack_id']
+            if phase == 'deleting':
+                combination['stack_ids'].pop()
+            running[stack_id] = combination
+            watcher.add(cfn_client, region, stack_id, 'create' if phase == 'creating' else 'delete')
+        elif phase == 'created' and not combination['cleaned'] and newest[-1].get('create_ok') \
+                and combination['created'] < len(combination.get('layers', [ None ])):
+            if not create_next(combination) and not delete_next(combination):
+                finish(combination)
+        elif not delete_next(combination):
+            finish(combination)
+
+    left_regions = set()
+    teardown_pool = ThreadPool(TEARDOWN_WORKERS)
+    for combination in in_flight:
+        resume(combination)
+    start_ready()
+    for event in watcher.events():
+        stack_id = event['stack_id']
+        combination = running.pop(stack_id)
+        region = combination['region']
+        result = results[(combination['stack_type'], region)]
+
+        if event['action'] == 'create':
+            journal.stack(stack_id, combination['stack_type'], region, 'created', event['status'], event['ok'])
+            set_result(combination['stack_type'], region, 'create', event['status'])
+            if not event['ok']:
+                print 'Stack failed to create stack id: {} - region: {} - status: {}'.format(stack_id, region, event['status'])
+            elif combination['created'] < len(combination.get('layers', [ None ])):
+                if create_next(combination):
+                    continue
+            if not delete_next(combination):
+                finish(combination)
+            continue
+
+        if event['status'] == 'START_FAILED':
+            # The older stacks are still imported from by this one, they are not deleted before it
+            if combination['attempts'] < REAP_ATTEMPTS:
+                print 'Retrying stack: {} - region: {} - error: {}'.format(stack_id, region, event['error'])
+                combination['stack_ids'].append(stack_id)
+                combination['cleaned'] = not combination['emptying']
+                delete_next(combination)
+                continue
+            print 'Stack failed to delete stack id: {} - region: {} - status: {} {}'.format(stack_id, region, event['status'], event['error'])
+            print 'Leaving the stacks of {} in {} for --reap'.format(combination['stack_type'], region)
+            left_regions.add(region)
+            set_result(combination['stack_type'], region, 'delete', event['status'])
+            # The stacks still hold their resources, so the entry keeps its share of the budget
+            journal.record('entry_done', stack_type=combination['stack_type'], region=region)
+            continue
 
-    # Wait for the stacks to delete
-    wait_for_stacks(stacks, False)
+        journal.stack(stack_id, combination['stack_type'], region, 'deleted', event['status'], event['ok'])
+        if not event['ok']:
+            print 'Stack failed to delete stack id: {} - region: {} - status: {}'.format(stack_id, region, event['status'])
+        if result.get('delete') in (None, 'DELETE_COMPLETE'):
+            set_result(combination['stack_type'], region, 'delete', event['status'])
+        if not delete_next(combination):
+            finish(combination)
+
+    teardown_pool.close()
+    teardown_pool.join()
+
+    # A foundation is left with the entries on top of it, --reap deletes them in order
+    for stack in [ stack for stack in foundation_stacks if stack['region'] in left_regions ]:
+        print 'Leaving shared foundation stack: {} - region: {} for --reap'.format(stack['stack_ids'][0], stack['region'])
+        foundation_stacks.remove(stack)
+    if foundation_stacks:
+        for region, status in delete_foundations(watcher, foundation_stacks, journal).items():
+            if ('vpc-bastion', region) in results:
+                set_result('vpc-bastion', region, 'delete', status)
+
+    print 'Results'
+    for stack_type in stack_types:
+        for region in regions:
+            if (stack_type, region) in results:
+                result = results[(stack_type, region)]
+                print '{:<55} {:<16} create: {:<20} delete: {}'.format(stack_type, region, result.get('create', '-'), result.get('delete', '-'))
+    print 'Status calls: {}'.format(watcher.calls)
+
+def reap_stack(cfn_client, s3_client, ecr_client, stack_id, fargate):
+    """ Teardown that still deletes the stack when emptying its fargate resources fails
+    """
+    try:
+        teardown_stack(cfn_client, s3_client, ecr_client, stack_id, fargate)
+    except (botocore.exceptions.ClientError, RuntimeError) as e:
+        if not fargate:
+            raise
+        print 'Failed to empty fargate resources of stack: {} - error: {}'.format(stack_id, e)
+        cfn_client.delete_stack(StackName=stack_id)
+
+def reap(context, watcher, journal):
+    """ Delete every stack, key pair and bucket the journal of an interrupted run knows about, and nothing else
+
+    Entries lose their newest stack first, a wave at a time, so no stack is deleted while
+    a later layer still imports from it. The shared foundations go last. A stack whose
+    delete could not be started is tried again in the next wave.
+    """
+    entries = {}
+    foundations = []
+    for stack in journal.stacks():
+        if stack['phase'] == 'deleted':
+            continue
+        if stack['foundation']:
+            foundations.append(stack)
+        else:
+            entries.setdefault((stack['stack_type'], stack['region']), []).append(stack)
+
+    attempts = {}
+    pool = ThreadPool(TEARDOWN_WORKERS)
+    try:
+        while True:
+            wave = [ stacks[-1] for stacks in entries.values() if stacks ] or list(foundations)
+            if not wave:
+                break
+            for stack in wave:
+                region = stack['region']
+                attempts[stack['stack_id']] = attempts.get(stack['stack_id'], 0) + 1
+                print 'Reaping stack: {} - region: {}'.format(stack['stack_id'], region)
+                # Only a fargate entry's newest stack holds the artifact bucket and repository
+                fargate = is_fargate(stack['stack_type']) and not stack['foundation'] and stack['phase'] != 'deleting'
+                started = pool.apply_async(reap_stack, (context.client('cloudformation', region),
+                    context.client('s3', region), context.client('ecr', region), stack['stack_id'], fargate))
+                watcher.add(context.client('cloudformation', region), region, stack['stack_id'], 'delete', after=started)
+            for event in watcher.events():
+                stack = [ stack for stack in wave if stack['stack_id'] == event['stack_id'] ][0]
+                if event['status'] == 'START_FAILED' and attempts[stack['stack_id']] < REAP_ATTEMPTS:
+                    print 'Retrying stack: {} - region: {} - error: {}'.format(event['stack_id'], event['region'], event['error'])
+                    continue
+                if event['status'] != 'START_FAILED':
+                    journal.stack(stack['stack_id'], stack['stack_type'], stack['region'], 'deleted', event['status'], event['ok'], stack['foundation'])
+                if not event['ok']:
+                    print 'Stack failed to delete stack id: {} - region: {} - status: {} {}'.format(event['stack_id'], event['region'], event['status'], event.get('error', ''))
+                if stack['foundation']:
+                    foundations.remove(stack)
+                else:
+                    entries[(stack['stack_type'], stack['region'])].remove(stack)
+    finally:
+        pool.close()
+        pool.join()
+
+    remove_keypairs(context, journal.key_pairs())
+    remove_app_buckets(context, journal.buckets())
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Create and delete every test stack in every supported region')
+    parser.add_argument('profile', help='AWS CLI profile name')
+    parser.add_argument('github_user', nargs='?')
+    parser.add_argument('github_repo', nargs='?')
+    parser.add_argument('github_token', nargs='?')
+    parser.add_argument('--shared-foundation', action='store_true', help='Build the vpc and bastion once per region and deploy each entry on top of it')
+    parser.add_argument('--timeline-dir', help='Save the create timeline of every stack here, see timeline.py compare')
+    parser.add_argument('--metrics', default=METRICS_FILE, help='File each API call is appended to as a JSON line')
+    parser.add_argument('--rate', action='append', type=rate_option, metavar='SERVICE=N', help='Starting calls per second per region for a service, repeatable')
+    parser.add_argument('--no-rate-limit', dest='rate_limit', action='store_false', help='Do not pace the API calls')
+    parser.add_argument('--journal', default=JOURNAL_FILE, help='File the run records everything it creates in')
+    parser.add_argument('--resume', action='store_true', help='Carry on an interrupted run from its journal')
+    parser.add_argument('--reap', action='store_true', help='Delete everything the journal of an interrupted run knows about')
+    args = parser.parse_args()
+    if not args.reap and not (args.github_user and args.github_repo and args.github_token):
+        parser.error('github_user, github_repo and github_token are required unless reaping')
+    return args
+
+def open_journal(args, tests):
+    """ Open the run journal, refusing to start over on top of an unfinished run
+    """
+    if args.resume or args.reap:
+        if not os.path.exists(args.journal):
+            sys.exit('No run journal at {}'.format(args.journal))
+        return RunJournal(args.journal)
+
+    if os.path.exists(args.journal):
+        previous = RunJournal(args.journal)
+        previous.close()
+        if previous.started and not previous.finished:
+            sys.exit('{} is the journal of an unfinished run, use --resume or --reap'.format(args.journal))
+    journal = RunJournal(args.journal, fresh=True)
+    journal.record('run', tests=tests, shared=args.shared_foundation)
+    return journal
 
 def main():
     """ Create the various stacks in all supported regions
     """
     print 'Testing stacks'
 
+    args = parse_args()
     github = {}
     config = Config(connect_timeout=60, read_timeout=60)
-    session = boto3.Session(profile_name=None if len(sys.argv) < 2 else sys.argv[1])
-    github['user'] = sys.argv[2]
-    github['repo'] = sys.argv[3]
-    github['token'] = sys.argv[4]
+    session = boto3.Session(profile_name=args.profile)
+    ApiMetrics(args.metrics).install(session).print_summary_at_exit()
+    if args.rate_limit:
+        RateLimiter(parse_rates(args.rate)).install(session).print_summary_at_exit()
+    context = RegionContext(session, config)
+    github['user'] = args.github_user
+    github['repo'] = args.github_repo
+    github['token'] = args.github_token
     print 'AWS session created'
 
-    key_pairs = ensure_foundation(session, config)
-
     tests = [
         'vpc',
         'vpc-bastion',
@@ -442,7 +1065,7 @@ def main():
         'vpc-bastion-eb-database-alarm',
         'vpc-bastion-eb-database-enhanced-alarm',
         'vpc-bastion-fargate',
-        'vpc-bastion-fargate-LB-alarm'
+        'vpc-bastion-fargate-LB-alarm',
         'vpc-bastion-fargate-database',
         'vpc-bastion-fargate-database-alarm',
         'vpc-bastion-fargate-database-enhanced-alarm',
@@ -451,12 +1074,31 @@ def main():
         'vpc-bastion-fargate-database-enhanced-alarm-LBalarm',
     ]
 
-    for test in tests:
-        test_stack(session, config, test, github, key_pairs)
+    journal = open_journal(args, tests)
+    watcher = StackWatcher(history_path=STACK_DURATIONS_FILE)
+
+    if args.reap:
+        reap(context, watcher, journal)
+    else:
+        # A resumed run keeps the options it was started with
+        options = journal.options()
+        key_pairs = ensure_foundation(context, journal)
+
+        if args.timeline_dir and not os.path.isdir(args.timeline_dir):
+            os.makedirs(args.timeline_dir)
 
-    remove_keypairs(session, config, key_pairs)
-    #we also need to add code to remove buckets created as part of test harness
+        run_matrix(context, watcher, options['tests'], github, key_pairs, options['shared'], args.timeline_dir, journal)
+
+        remove_keypairs(context, key_pairs)
+        remove_app_buckets(context, journal.buckets())
+
+    left = [ stack for stack in journal.stacks() if stack['phase'] != 'deleted' ]
+    if left:
+        # The journal stays unfinished so --reap can still find them
+        print '{} stacks were not deleted, run again with --reap to remove them'.format(len(left))
+    else:
+        journal.record('finished')
+    journal.close()
 
 if __name__ == '__main__':
     main()
-
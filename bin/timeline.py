@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+
+""" Rebuild when each resource of a stack, and of every stack it nests, started and finished creating
+
+Run with: python timeline.py show profile_name region stack_name [--save FILE]
+      or: python timeline.py compare FILE [FILE ...]
+
+Saved profiles hold times relative to the start of the top-level stack and name each
+resource by its logical id path, so profiles from different regions and runs line up.
+"""
+
+import boto3, argparse, calendar, json, sys
+
+NESTED_STACK_TYPE='AWS::CloudFormation::Stack'
+
+# A resource is taken to have waited on another that finished at most this many seconds after it started
+CHAIN_SLACK=1.0
+
+TIMELINE_WIDTH=60
+
+def epoch(timestamp):
+    return calendar.timegm(timestamp.utctimetuple()) + timestamp.microsecond / 1000000.0
+
+def text(value):
+    return '-' if value is None else str(value)
+
+def stack_events(client, stack_id):
+    """ Every event of a stack, oldest first
+    """
+    events = []
+    for page in client.get_paginator('describe_stack_events').paginate(StackName=stack_id):
+        events.extend(page['StackEvents'])
+    events.sort(key=lambda event: event['Timestamp'])
+    return events
+
+def create_spans(events):
+    """ The first CREATE_IN_PROGRESS and the last CREATE_COMPLETE or CREATE_FAILED of each logical id
+    """
+    spans = {}
+    for event in events:
+        status = event['ResourceStatus']
+        if not status.startswith('CREATE_'):
+            continue
+        span = spans.setdefault(event['LogicalResourceId'], {
+            'logical_id': event['LogicalResourceId'],
+            'type': event['ResourceType'],
+            'physical_id': event.get('PhysicalResourceId'),
+            'start': None,
+            'end': None,
+            'status': None,
+        })
+        if event.get('PhysicalResourceId'):
+            span['physical_id'] = event['PhysicalResourceId']
+        if status == 'CREATE_IN_PROGRESS':
+            if span['start'] is None:
+                span['start'] = epoch(event['Timestamp'])
+        else:
+            span['end'] = epoch(event['Timestamp'])
+            span['status'] = status
+    return spans
+
+def profile_stack(client, stack_id, region=None):
+    """ The create timeline of a stack, following nested stacks down through their physical ids
+    """
+    events = stack_events(client, stack_id)
+    spans = create_spans(events)
+    root = None
+    resources = []
+    for logical_id, span in spans.items():
+        if span['type'] == NESTED_STACK_TYPE and span['physical_id'] == events[0]['StackId']:
+            root = span
+            continue
+        if span['type'] == NESTED_STACK_TYPE and span['physical_id'] and span['physical_id'].startswith('arn:'):
+            span['stack'] = profile_stack(client, span['physical_id'], region)
+        resources.append(span)
+    resources.sort(key=lambda span: (span['start'] is None, span['start']))
+    return {
+        'stack_name': events[0]['StackName'],
+        'stack_id': events[0]['StackId'],
+        'region': region,
+        'start': root['start'] if root else epoch(events[0]['Timestamp']),
+        'end': root['end'] if root else None,
+        'status': root['status'] if root else None,
+        'resources': resources,
+    }
+
+def critical_path(profile):
+    """ The chain of resources that decided when the stack finished, nested stacks expanded in place
+
+    CloudFormation starts a resource as soon as everything it depends on is done, so
+    walking back from the last resource to finish, each step is the resource that
+    finished last before the current one started.
+    """
+    finished = [ span for span in profile['resources'] if span['start'] is not None and span['end'] is not None ]
+    chain = []
+    current = max(finished, key=lambda span: span['end']) if finished else None
+    while current is not None:
+        chain.append(current)
+        before = [ span for span in finished if span['end'] <= current['start'] + CHAIN_SLACK and span not in chain ]
+        current = max(before, key=lambda span: span['end']) if before else None
+
+    path = []
+    for span in reversed(chain):
+        path.append((span['logical_id'], span))
+        if 'stack' in span:
+            for name, nested in critical_path(span['stack']):
+                path.append(('{}/{}'.format(span['logical_id'], name), nested))
+    return path
+
+def flatten(profile, origin=None, prefix=''):
+    """ One row per resource with its logical id path and its times relative to origin
+    """
+    origin = profile['start'] if origin is None else origin
+    rows = []
+    for span in profile['resources']:
+        name = prefix + span['logical_id']
+        rows.append({
+            'path': name,
+            'type': span['type'],
+            'status': span['status'],
+            'start': None if span['start'] is None else round(span['start'] - origin, 1),
+            'seconds': None if span['start'] is None or span['end'] is None else round(span['end'] - span['start'], 1),
+        })
+        if 'stack' in span:
+            rows.extend(flatten(span['stack'], origin, name + '/'))
+    return rows
+
+def summary(profile):
+    """ The JSON friendly form of a profile that is saved and compared
+    """
+    return {
+        'stack_name': profile['stack_name'],
+        'region': profile['region'],
+        'status': profile['status'],
+        'seconds': None if profile['end'] is None else round(profile['end'] - profile['start'], 1),
+        'resources': flatten(profile),
+        'critical_path': [ name for name, _ in critical_path(profile) ],
+    }
+
+def save_profile(path, profile):
+    with open(path, 'w') as f:
+        json.dump(summary(profile), f, indent=2, sort_keys=True)
+
+def print_timeline(saved, stream=sys.stdout):
+    """ Draw each resource as a bar on a shared time axis, marking the critical path with *
+    """
+    rows = [ row for row in saved['resources'] if row['start'] is not None ]
+    total = saved['seconds'] or max([ row['start'] + (row['seconds'] or 0) for row in rows ] or [ 1 ])
+    scale = TIMELINE_WIDTH / float(total or 1)
+    critical = set(saved['critical_path'])
+    stream.write('{} {} {} in {}s\n'.format(saved['stack_name'], saved['region'], text(saved['status']), text(saved['seconds'])))
+    for row in rows:
+        offset = int(row['start'] * scale)
+        length = max(1, int((row['seconds'] or 0) * scale))
+        stream.write('{} {:<60} {:>7} {:>7} |{}{}\n'.format('*' if row['path'] in critical else ' ', row['path'][-60:],
+            row['start'], text(row['seconds']), ' ' * offset, '#' * length))
+
+def print_critical_path(saved, stream=sys.stdout):
+    rows = dict((row['path'], row) for row in saved['resources'])
+    for name in saved['critical_path']:
+        row = rows[name]
+        stream.write('  {:<60} {:<40} {:>7}s\n'.format(name, row['type'], text(row['seconds'])))
+
+def compare(saved_profiles, stream=sys.stdout):
+    """ Resource durations side by side, slowest first by their worst time
+    """
+    durations = {}
+    for index, saved in enumerate(saved_profiles):
+        for row in saved['resources']:
+            durations.setdefault(row['path'], [ None ] * len(saved_profiles))[index] = row['seconds']
+    stream.write('{:<60} {}\n'.format('resource', ' '.join('{:>16}'.format(saved['region']) for saved in saved_profiles)))
+    stream.write('{:<60} {}\n'.format('total', ' '.join('{:>16}'.format(text(saved['seconds'])) for saved in saved_profiles)))
+    for path, seconds in sorted(durations.items(), key=lambda item: -max(value or 0 for value in item[1])):
+        stream.write('{:<60} {}\n'.format(path[-60:], ' '.join('{:>16}'.format(text(value)) for value in seconds)))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Show where the time went while a stack was created')
+    commands = parser.add_subparsers(dest='command')
+    show = commands.add_parser('show', help='Profile a stack and print its timeline and critical path')
+    show.add_argument('profile', help='AWS CLI profile name')
+    show.add_argument('region')
+    show.add_argument('stack_name')
+    show.add_argument('--save', help='Also save the profile as JSON for compare')
+    compare_parser = commands.add_parser('compare', help='Compare saved profiles across regions or runs')
+    compare_parser.add_argument('files', nargs='+')
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    if args.command == 'compare':
+        saved_profiles = []
+        for path in args.files:
+            with open(path) as f:
+                saved_profiles.append(json.load(f))
+        compare(saved_profiles)
+        return
+
+    client = boto3.Session(profile_name=args.profile).client('cloudformation', region_name=args.region)
+    profile = profile_stack(client, args.stack_name, args.region)
+    saved = summary(profile)
+    print_timeline(saved)
+    sys.stdout.write('\nCritical path\n')
+    print_critical_path(saved)
+    if args.save:
+        save_profile(args.save, profile)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,412 @@
+#!/usr/bin/env python
+
+""" Offline checks of the templates and of the parameters the test harness sends them
+
+Run with: python bin/validate.py [--regions us-east-1,eu-west-1]
+
+Every root *.cfn.yml and templates/*.cfn.yml is parsed on first use into a TemplateIndex
+of parameters, outputs, exports and nested stack edges. A parameter set is then checked
+down through the nested stacks it would create, so a parent passing a parameter its
+child does not declare, a value outside AllowedValues or a missing AMIMap region is
+found in well under a second instead of after a stack rolls back. The harness only
+parses the templates its matrix reaches.
+"""
+
+import argparse, glob, hashlib, json, os, re, sys
+from ruamel.yaml import YAML
+from ruamel.yaml.constructor import DuplicateKeyError
+
+ROOT=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+TEMPLATE_GLOBS = [ '*.cfn.yml', 'templates/*.cfn.yml' ]
+
+# The index of each template is cached by its MD5 at the repository root, wherever the tools run.
+# Parsing them all takes about a second with the pure Python parser and a quarter of that with
+# ruamel.yaml.clib, which is used when it is installed.
+CACHE_FILE=os.path.join(ROOT, 'template-index.json')
+CACHE_VERSION=1
+
+NESTED_STACK_TYPE='AWS::CloudFormation::Stack'
+AMI_TEMPLATE='templates/bastion.cfn.yml'
+AMI_MAPPING='AMIMap'
+
+# The template path a nested stack TemplateURL ends in, after the ${TemplateBucket} part
+TEMPLATE_PATH = re.compile(r'^https://[^/]+/[^/]+/(.+)$')
+EXPORT_NAME = re.compile(r'^\$\{AWS::StackName\}-(.+)$')
+IMPORT_NAME = re.compile(r'^\$\{(\w+)\}-(.+)$')
+SUB_VARIABLE = re.compile(r'\$\{([^}!]+)\}')
+DUPLICATE_KEY = re.compile(r'duplicate key "([^"]*)"')
+
+# Values that cannot be worked out offline
+UNKNOWN = object()
+
+STRING_TYPES = (str,) if sys.version_info[0] > 2 else (basestring,)
+
+def intrinsic(loader, suffix, node):
+    """ Turn the short form !Ref, !Sub, !GetAtt ... tags into their long form dicts
+    """
+    if suffix == 'Ref':
+        return { 'Ref': loader.construct_scalar(node) }
+    name = 'Condition' if suffix == 'Condition' else 'Fn::{}'.format(suffix)
+    if node.id == 'scalar':
+        value = loader.construct_scalar(node)
+        if suffix == 'GetAtt':
+            value = value.split('.', 1)
+    elif node.id == 'sequence':
+        value = loader.construct_sequence(node, deep=True)
+    else:
+        value = loader.construct_mapping(node, deep=True)
+    return { name: value }
+
+def load_yaml(path, allow_duplicate_keys=False):
+    yaml = YAML(typ='safe')
+    yaml.allow_duplicate_keys = allow_duplicate_keys
+    yaml.constructor.add_multi_constructor('!', intrinsic)
+    with open(path) as f:
+        return yaml.load(f)
+
+def template_path(url):
+    """ The repository path of a TemplateURL, given as a plain string or an Fn::Sub
+    """
+    if isinstance(url, dict) and 'Fn::Sub' in url:
+        url = url['Fn::Sub']
+        if isinstance(url, list):
+            url = url[0]
+    if not isinstance(url, STRING_TYPES):
+        return None
+    match = TEMPLATE_PATH.match(url)
+    return match.group(1) if match else None
+
+class TemplateIndex(object):
+    """ Parameters, outputs, exports, mappings and nested stacks of every template, by repository path
+    """
+
+    def __init__(self, root=ROOT, cache_path=CACHE_FILE):
+        self.root = root
+        self.cache_path = cache_path
+        self.cache = load_cache(cache_path)
+        self.paths = {}
+        for pattern in TEMPLATE_GLOBS:
+            for path in sorted(glob.glob(os.path.join(root, pattern))):
+                self.paths[os.path.relpath(path, root).replace(os.sep, '/')] = path
+        # The templates loaded so far, by repository path
+        self.templates = {}
+        self._exports = None
+
+    def load(self, keys):
+        """ Load templates and every template they nest, saving the cache once if any had to be parsed
+        """
+        pending = [ key for key in keys if key in self.paths ]
+        changed = False
+        while pending:
+            key = pending.pop()
+            if key in self.templates:
+                continue
+            with open(self.paths[key], 'rb') as f:
+                md5 = hashlib.md5(f.read()).hexdigest()
+            entry = self.cache['templates'].get(key)
+            if entry is None or entry['md5'] != md5:
+                entry = { 'md5': md5, 'index': self._index(key, self.paths[key]) }
+                self.cache['templates'][key] = entry
+                changed = True
+            self.templates[key] = entry['index']
+            pending.extend(stack['template'] for stack in entry['index']['nested'].values() if stack['template'] in self.paths)
+        # Templates that no longer exist are dropped from the cache
+        for key in set(self.cache['templates']) - set(self.paths):
+            del self.cache['templates'][key]
+            changed = True
+        if self.cache_path and changed:
+            save_cache(self.cache_path, self.cache)
+
+    def template(self, key):
+        """ The index of one template, None if the repository has no such template
+        """
+        if key not in self.templates:
+            self.load([ key ])
+        return self.templates.get(key)
+
+    def exports(self):
+        """ The export name suffixes of every template
+        """
+        if self._exports is None:
+            self.load(self.paths)
+            self._exports = set()
+            for template in self.templates.values():
+                self._exports.update(template['exports'])
+        return self._exports
+
+    def _index(self, key, path):
+        load_errors = []
+        try:
+            body = load_yaml(path)
+        except DuplicateKeyError as e:
+            load_errors.append('{}: duplicate key {}'.format(key, DUPLICATE_KEY.search(str(e)).group(1)))
+            body = load_yaml(path, allow_duplicate_keys=True)
+        body = body or {}
+
+        outputs = body.get('Outputs') or {}
+        exports = set()
+        for output in outputs.values():
+            name = (output.get('Export') or {}).get('Name')
+            if isinstance(name, dict) and isinstance(name.get('Fn::Sub'), STRING_TYPES):
+                match = EXPORT_NAME.match(name['Fn::Sub'])
+                if match:
+                    exports.add(match.group(1))
+        nested = {}
+        imports = []
+        for logical_id, resource in (body.get('Resources') or {}).items():
+            if resource.get('Type') == NESTED_STACK_TYPE:
+                properties = resource.get('Properties') or {}
+                nested[logical_id] = {
+                    'template': template_path(properties.get('TemplateURL')),
+                    'parameters': properties.get('Parameters') or {},
+                    'condition': resource.get('Condition'),
+                }
+            imports.extend(find_imports(resource))
+        return {
+            'load_errors': load_errors,
+            'parameters': body.get('Parameters') or {},
+            'conditions': body.get('Conditions') or {},
+            'mappings': body.get('Mappings') or {},
+            'outputs': sorted(outputs),
+            'exports': sorted(exports),
+            'nested': nested,
+            'imports': imports,
+            'nested_outputs': [ list(item) for item in find_nested_outputs(body) ],
+        }
+
+    def check_template(self, key):
+        """ Problems visible in one template without any parameter values
+        """
+        template = self.template(key)
+        errors = list(template['load_errors'])
+        for logical_id, stack in sorted(template['nested'].items()):
+            if stack['template'] is None:
+                continue
+            child = self.template(stack['template'])
+            if child is None:
+                errors.append('{} {}: nested template {} does not exist'.format(key, logical_id, stack['template']))
+                continue
+            for name in sorted(stack['parameters']):
+                if name not in child['parameters']:
+                    errors.append('{} {}: passes {} which {} does not declare'.format(key, logical_id, name, stack['template']))
+            for name, parameter in sorted(child['parameters'].items()):
+                if 'Default' not in parameter and name not in stack['parameters']:
+                    errors.append('{} {}: does not pass {} which {} requires'.format(key, logical_id, name, stack['template']))
+        for logical_id, output in template['nested_outputs']:
+            stack = template['nested'].get(logical_id)
+            child = self.template(stack['template']) if stack else None
+            if child is not None and output not in child['outputs']:
+                errors.append('{}: reads {}.Outputs.{} which {} does not output'.format(key, logical_id, output, stack['template']))
+        for suffix in template['imports']:
+            if suffix not in self.exports():
+                errors.append('{}: imports *-{} which no template exports'.format(key, suffix))
+        return errors
+
+    def check_all(self):
+        self.load(self.paths)
+        errors = []
+        for key in sorted(self.templates):
+            errors.extend(self.check_template(key))
+        return errors
+
+    def check_parameters(self, key, values, path=None):
+        """ Problems with creating template key from a dict of parameter values, following nested stacks
+        """
+        path = path or key
+        template = self.template(key)
+        if template is None:
+            return [ '{}: template {} does not exist'.format(path, key) ]
+        errors = []
+        for name in sorted(values):
+            if name not in template['parameters']:
+                errors.append('{}: parameter {} is not declared'.format(path, name))
+        resolved = {}
+        for name, parameter in sorted(template['parameters'].items()):
+            if name in values:
+                value = values[name]
+            elif 'Default' in parameter:
+                value = parameter['Default']
+            else:
+                errors.append('{}: parameter {} is required'.format(path, name))
+                continue
+            resolved[name] = value
+            if value is not UNKNOWN:
+                errors.extend('{}: {}'.format(path, error) for error in check_value(name, parameter, value))
+
+        evaluator = Evaluator(template, resolved)
+        for logical_id, stack in sorted(template['nested'].items()):
+            if stack['template'] is None or (stack['condition'] and evaluator.condition(stack['condition']) is False):
+                continue
+            child_values = dict((name, evaluator.value(value)) for name, value in stack['parameters'].items())
+            errors.extend(self.check_parameters(stack['template'], child_values, '{} > {}'.format(path, logical_id)))
+        return errors
+
+    def check_regions(self, regions):
+        """ Regions missing from the bastion AMIMap
+        """
+        mapping = self.template(AMI_TEMPLATE)['mappings'].get(AMI_MAPPING, {})
+        return [ '{}: {} has no entry for {}'.format(AMI_TEMPLATE, AMI_MAPPING, region) for region in sorted(regions) if region not in mapping ]
+
+def load_cache(path):
+    """ Load the index cache, a missing or unreadable cache is treated as empty
+    """
+    try:
+        with open(path) as f:
+            cache = json.load(f)
+        if cache.get('version') == CACHE_VERSION:
+            return cache
+    except (IOError, OSError, TypeError, ValueError):
+        pass
+    return { 'version': CACHE_VERSION, 'templates': {} }
+
+def save_cache(path, cache):
+    """ Write the cache next to its final location first so an interrupted run cannot corrupt it
+    """
+    tmp = '{}.tmp'.format(path)
+    with open(tmp, 'w') as f:
+        json.dump(cache, f, sort_keys=True, default=str)
+    os.rename(tmp, path)
+
+def cfn_string(value):
+    """ A parameter value as CloudFormation sees it, unquoted YAML booleans are the strings true and false
+    """
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return str(value)
+
+def check_value(name, parameter, value):
+    value = cfn_string(value)
+    errors = []
+    allowed = parameter.get('AllowedValues')
+    if allowed is not None and value not in [ cfn_string(item) for item in allowed ]:
+        errors.append('parameter {} value {} is not one of {}'.format(name, value, ', '.join(cfn_string(item) for item in allowed)))
+    pattern = parameter.get('AllowedPattern')
+    if pattern is not None and re.match('^(?:{})$'.format(pattern), value) is None:
+        errors.append('parameter {} value {} does not match {}'.format(name, value, pattern))
+    if parameter.get('Type') == 'Number':
+        try:
+            number = float(value)
+        except ValueError:
+            return errors + [ 'parameter {} value {} is not a number'.format(name, value) ]
+        if 'MinValue' in parameter and number < float(parameter['MinValue']):
+            errors.append('parameter {} value {} is below {}'.format(name, value, parameter['MinValue']))
+        if 'MaxValue' in parameter and number > float(parameter['MaxValue']):
+            errors.append('parameter {} value {} is above {}'.format(name, value, parameter['MaxValue']))
+    if 'MinLength' in parameter and len(value) < int(parameter['MinLength']):
+        errors.append('parameter {} is shorter than {}'.format(name, parameter['MinLength']))
+    if 'MaxLength' in parameter and len(value) > int(parameter['MaxLength']):
+        errors.append('parameter {} is longer than {}'.format(name, parameter['MaxLength']))
+    return errors
+
+def walk(node):
+    yield node
+    if isinstance(node, dict):
+        for value in node.values():
+            for child in walk(value):
+                yield child
+    elif isinstance(node, list):
+        for value in node:
+            for child in walk(value):
+                yield child
+
+def find_imports(resource):
+    """ The export suffix of every Fn::ImportValue of the form ${SomeStackName}-Suffix
+    """
+    suffixes = []
+    for node in walk(resource):
+        if isinstance(node, dict) and 'Fn::ImportValue' in node:
+            name = node['Fn::ImportValue']
+            if isinstance(name, dict) and isinstance(name.get('Fn::Sub'), STRING_TYPES):
+                match = IMPORT_NAME.match(name['Fn::Sub'])
+                if match:
+                    suffixes.append(match.group(2))
+    return suffixes
+
+def find_nested_outputs(body):
+    """ (logical id, output) for every GetAtt Stack.Outputs.Name in a template
+    """
+    found = set()
+    for node in walk(body):
+        if isinstance(node, dict) and isinstance(node.get('Fn::GetAtt'), list):
+            attribute = '.'.join(str(part) for part in node['Fn::GetAtt'])
+            if '.Outputs.' in attribute:
+                found.add(tuple(attribute.split('.Outputs.', 1)))
+    return sorted(found)
+
+class Evaluator(object):
+    """ Works out Ref, Fn::If and the condition functions from known parameter values, anything else is UNKNOWN
+    """
+
+    def __init__(self, template, parameters):
+        self.template = template
+        self.parameters = parameters
+        self.conditions = {}
+
+    def condition(self, name):
+        if name not in self.conditions:
+            definition = self.template['conditions'].get(name)
+            self.conditions[name] = UNKNOWN if definition is None else self.truth(definition)
+        return self.conditions[name]
+
+    def truth(self, node):
+        if isinstance(node, dict):
+            if 'Condition' in node:
+                return self.condition(node['Condition'])
+            if 'Fn::Equals' in node:
+                left, right = [ self.value(item) for item in node['Fn::Equals'] ]
+                if left is UNKNOWN or right is UNKNOWN:
+                    return UNKNOWN
+                return cfn_string(left) == cfn_string(right)
+            if 'Fn::Not' in node:
+                value = self.truth(node['Fn::Not'][0])
+                return UNKNOWN if value is UNKNOWN else not value
+            if 'Fn::And' in node or 'Fn::Or' in node:
+                values = [ self.truth(item) for item in node.get('Fn::And', node.get('Fn::Or')) ]
+                if 'Fn::And' in node:
+                    return False if False in values else (UNKNOWN if UNKNOWN in values else True)
+                return True if True in values else (UNKNOWN if UNKNOWN in values else False)
+        return UNKNOWN
+
+    def value(self, node):
+        if isinstance(node, dict):
+            if 'Ref' in node:
+                return self.parameters.get(node['Ref'], UNKNOWN)
+            if 'Fn::If' in node:
+                name, when_true, when_false = node['Fn::If']
+                truth = self.condition(name)
+                if truth is UNKNOWN:
+                    return UNKNOWN
+                return self.value(when_true if truth else when_false)
+            if isinstance(node.get('Fn::Sub'), STRING_TYPES):
+                names = SUB_VARIABLE.findall(node['Fn::Sub'])
+                if any(name not in self.parameters or self.parameters[name] is UNKNOWN for name in names):
+                    return UNKNOWN
+                return SUB_VARIABLE.sub(lambda match: cfn_string(self.parameters[match.group(1)]), node['Fn::Sub'])
+            return UNKNOWN
+        if isinstance(node, list):
+            return UNKNOWN
+        return node
+
+def parameter_values(parameters):
+    """ The dict form of a create_stack Parameters list
+    """
+    return dict((parameter['ParameterKey'], parameter['ParameterValue']) for parameter in parameters)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Check the templates and their nested stack wiring offline')
+    parser.add_argument('--regions', default='', help='Comma separated regions that must be in the bastion AMIMap')
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    index = TemplateIndex()
+    errors = index.check_all()
+    if args.regions:
+        errors.extend(index.check_regions(args.regions.split(',')))
+    for error in errors:
+        print(error)
+    sys.stderr.write('{} templates, {} problems\n'.format(len(index.templates), len(errors)))
+    sys.exit(1 if errors else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,200 @@
+""" Batched CloudFormation stack status watcher
+
+One list_stacks call per region per tick replaces a describe_stacks call per stack,
+and the time between ticks backs off based on how long the same stack took last time.
+"""
+
+import json, random, time
+
+ALL_STATUSES = [
+    'CREATE_IN_PROGRESS', 'CREATE_FAILED', 'CREATE_COMPLETE',
+    'ROLLBACK_IN_PROGRESS', 'ROLLBACK_FAILED', 'ROLLBACK_COMPLETE',
+    'DELETE_IN_PROGRESS', 'DELETE_FAILED', 'DELETE_COMPLETE',
+    'UPDATE_IN_PROGRESS', 'UPDATE_COMPLETE_CLEANUP_IN_PROGRESS', 'UPDATE_COMPLETE',
+    'UPDATE_ROLLBACK_IN_PROGRESS', 'UPDATE_ROLLBACK_FAILED',
+    'UPDATE_ROLLBACK_COMPLETE_CLEANUP_IN_PROGRESS', 'UPDATE_ROLLBACK_COMPLETE',
+    'REVIEW_IN_PROGRESS',
+]
+
+# The status a stack is in while the action runs and the status it ends in when it works
+ACTIONS = {
+    'create': ('CREATE_IN_PROGRESS', 'CREATE_COMPLETE'),
+    'delete': ('DELETE_IN_PROGRESS', 'DELETE_COMPLETE'),
+}
+
+# Starting guesses, in seconds, until a stack of the same name has been seen to finish
+DEFAULT_DURATIONS = { 'create': 900, 'delete': 600 }
+
+MIN_INTERVAL=5
+MAX_INTERVAL=60
+HISTORY_SIZE=10
+
+# Ticks a stack may be missing from a full listing before it is reported as gone
+MISSING_LIMIT=3
+
+def stack_name(stack_id):
+    """ Pull the stack name out of a stack id, a plain name is returned unchanged
+    """
+    if stack_id.startswith('arn:'):
+        return stack_id.split(':')[5].split('/')[1]
+    return stack_id
+
+class StackWatcher(object):
+    """ Wait on many stacks across regions and yield an event as each one finishes
+    """
+
+    def __init__(self, history_path=None, min_interval=MIN_INTERVAL, max_interval=MAX_INTERVAL, sleep=time.sleep, clock=time.time):
+        self.history_path = history_path
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.sleep = sleep
+        self.clock = clock
+        self.calls = 0
+        self.pending = {}
+        self.history = self._load_history()
+
+    def _load_history(self):
+        if self.history_path is None:
+            return {}
+        try:
+            with open(self.history_path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _save_history(self):
+        if self.history_path is None:
+            return
+        with open(self.history_path, 'w') as f:
+            json.dump(self.history, f, indent=2, sort_keys=True)
+
+    def expected_duration(self, action, name):
+        """ Median of the recent durations for this stack, or the default for the action
+        """
+        durations = sorted(self.history.get('{}:{}'.format(action, name), []))
+        if not durations:
+            return DEFAULT_DURATIONS[action]
+        return durations[len(durations) // 2]
+
+    def record_duration(self, action, name, seconds):
+        key = '{}:{}'.format(action, name)
+        self.history[key] = (self.history.get(key, []) + [ seconds ])[-HISTORY_SIZE:]
+
+    def next_interval(self, remaining):
+        """ Poll rarely while stacks are far from their usual finish time and often once they are close
+        """
+        remaining = min(remaining)
+        interval = min(self.max_interval, max(self.min_interval, remaining / 4.0))
+        # Jitter keeps many regions and harness runs from polling in lockstep
+        return random.uniform(self.min_interval, interval)
+
+    def list_statuses(self, client, stack_ids):
+        """ Return {stack_id: status} for the given stacks using as few list_stacks pages as possible
+        """
+        wanted = set(stack_ids)
+        statuses = {}
+        kwargs = { 'StackStatusFilter': ALL_STATUSES }
+        while True:
+            self.calls += 1
+            response = client.list_stacks(**kwargs)
+            for summary in response['StackSummaries']:
+                if summary['StackId'] in wanted:
+                    statuses[summary['StackId']] = summary['StackStatus']
+            # Newest stacks come first so the pages can usually stop early
+            if len(statuses) == len(wanted) or 'NextToken' not in response:
+                return statuses
+            kwargs['NextToken'] = response['NextToken']
+
+    def add(self, client, region, stack_id, action, after=None):
+        """ Start watching a stack, safe to call while events() is being consumed
+
+        after is an optional AsyncResult for the call that starts the action, the stack
+        is not polled until it is ready and is reported as START_FAILED if it raised.
+        """
+        self.pending[stack_id] = {
+            'after': after,
+            'client': client,
+            'region': region,
+            'action': action,
+            'expected': self.expected_duration(action, stack_name(stack_id)),
+            'start': self.clock(),
+            'missing': 0,
+        }
+
+    def watch(self, stacks, action):
+        """ Yield a completion event for every stack id in stacks as it leaves the in progress state
+
+        stacks is a list of dicts with 'client', 'region' and 'stack_ids', the same shape
+        test.py builds.
+        """
+        for stack in stacks:
+            for stack_id in stack['stack_ids']:
+                self.add(stack['client'], stack['region'], stack_id, action)
+        for event in self.events():
+            yield event
+
+    def events(self):
+        """ Yield an event dict with action, region, stack_id, status, ok and seconds as each
+        watched stack finishes, until nothing is left to watch
+        """
+        try:
+            while self.pending:
+                by_region = {}
+                for stack_id, state in list(self.pending.items()):
+                    if state['after'] is not None:
+                        if not state['after'].ready():
+                            continue
+                        if not state['after'].successful():
+                            del self.pending[stack_id]
+                            try:
+                                state['after'].get()
+                            except Exception as e:
+                                error = e
+                            yield {
+                                'action': state['action'],
+                                'region': state['region'],
+                                'stack_id': stack_id,
+                                'status': 'START_FAILED',
+                                'ok': False,
+                                'seconds': self.clock() - state['start'],
+                                'error': error,
+                            }
+                            continue
+                        state['after'] = None
+                        state['start'] = self.clock()
+                    by_region.setdefault(state['region'], []).append(stack_id)
+
+                for region, stack_ids in sorted(by_region.items()):
+                    statuses = self.list_statuses(self.pending[stack_ids[0]]['client'], stack_ids)
+                    for stack_id in stack_ids:
+                        state = self.pending[stack_id]
+                        status = statuses.get(stack_id)
+                        if status is None:
+                            state['missing'] += 1
+                            if state['missing'] < MISSING_LIMIT:
+                                continue
+                            status = 'MISSING'
+                        state['missing'] = 0
+                        in_progress, complete = ACTIONS[state['action']]
+                        if status == in_progress:
+                            continue
+
+                        seconds = self.clock() - state['start']
+                        del self.pending[stack_id]
+                        if status == complete:
+                            self.record_duration(state['action'], stack_name(stack_id), seconds)
+                        yield {
+                            'action': state['action'],
+                            'region': region,
+                            'stack_id': stack_id,
+                            'status': status,
+                            # Deleted stacks stay listed, one that vanished entirely is gone too
+                            'ok': status == complete or (state['action'] == 'delete' and status == 'MISSING'),
+                            'seconds': seconds,
+                        }
+
+                if self.pending:
+                    now = self.clock()
+                    self.sleep(self.next_interval([ state['expected'] - (now - state['start']) for state in self.pending.values() ]))
+        finally:
+            self._save_history()